@@ -1,34 +1,55 @@
 from aiohttp import web
 
-from init_db import init_database
+from main import statements
+from main.cache import MergeCache, TemplateCache
+from main.config import load_config
 from main.models import pg_context
+from main.notify import listen_context
 from main.routes import setup_routes
-from main.middleware import validate_id_middleware, validate_json_body_middleware
+from main.limiter import AIMDLimiter
+from main.metrics import Metrics
+from main.middleware import (
+    concurrency_limit_middleware,
+    metrics_middleware,
+    profiling_middleware,
+    validate_json_body_middleware,
+)
+from main.workers import Supervisor
 
 
 async def init_app() -> web.Application:
     print("Init APP")
     router = web.RouteTableDef()
-    app = web.Application(middlewares=[validate_id_middleware, validate_json_body_middleware])
+    # Ids are validated by the route patterns in setup_routes, trailing slashes are redirected away
+    app = web.Application(
+        middlewares=[
+            profiling_middleware,
+            metrics_middleware,
+            web.normalize_path_middleware(append_slash=False, remove_slash=True),
+            concurrency_limit_middleware,
+            validate_json_body_middleware,
+        ]
+    )
     app.add_routes(router)
-    await init_database()
 
     setup_routes(app)
 
-    app["config"] = {
-        "postgres": {
-            "database": "postgres",
-            "user": "postgres",
-            "password": "password",
-            "host": "postgres_db",
-            "port": "5432",
-        }
-    }
+    app["config"] = load_config()
+    app["metrics"] = Metrics()
+    app["template_cache"] = TemplateCache(**app["config"]["template_cache"])
+    app["merge_cache"] = MergeCache(**app["config"]["merge_cache"])
+    app["limiters"] = {budget: AIMDLimiter(**conf) for budget, conf in app["config"]["limiter"].items()}
+    statements.configure(prepared=app["config"]["postgres"]["prepared_statements"])
 
     app.cleanup_ctx.append(pg_context)
+    app.cleanup_ctx.append(listen_context)
 
     return app
 
 
 if __name__ == "__main__":
-    web.run_app(init_app())
+    server = load_config()["server"]
+    if server["workers"] > 1:
+        Supervisor(init_app, **server).run()
+    else:
+        web.run_app(init_app(), host=server["host"], port=server["port"], shutdown_timeout=server["shutdown_timeout"])
@@ -0,0 +1,152 @@
+import argparse
+import asyncio
+import json
+import math
+import time
+from collections import defaultdict
+
+from aiohttp import ClientError, ClientSession, web
+from aiohttp.test_utils import TestServer, make_mocked_request
+
+from app import init_app
+from main.routes import setup_routes
+
+
+def load_log(path: str) -> list:
+    entries = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            # Lines that are not requests (method + path) are skipped, so annotated logs can be replayed as is
+            if "method" in entry and "path" in entry:
+                entries.append(entry)
+    return entries
+
+
+async def resolve_route_names(entries: list) -> dict:
+    app = web.Application()
+    setup_routes(app)
+    names = {}
+    for entry in entries:
+        key = (entry["method"], entry["path"])
+        if key not in names:
+            match_info = await app.router.resolve(make_mocked_request(*key, app=app))
+            names[key] = match_info.route.name or "unmatched"
+    return names
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    # nearest-rank
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+async def replay(url: str, entries: list, names: dict, concurrency: int, repeat: int) -> tuple:
+    queue = asyncio.Queue()
+    for _ in range(repeat):
+        for entry in entries:
+            queue.put_nowait(entry)
+    results = []
+
+    async def worker(session: ClientSession):
+        while not queue.empty():
+            entry = queue.get_nowait()
+            start = time.monotonic()
+            try:
+                async with session.request(entry["method"], url + entry["path"], json=entry.get("body")) as resp:
+                    await resp.read()
+                    status = resp.status
+            except ClientError:
+                status = 0
+            results.append((names[(entry["method"], entry["path"])], status, time.monotonic() - start))
+
+    start = time.monotonic()
+    async with ClientSession() as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    return results, time.monotonic() - start
+
+
+def summarize(results: list, elapsed: float, concurrency: int) -> dict:
+    by_route = defaultdict(list)
+    errors = defaultdict(int)
+    for route, status, latency in results:
+        by_route[route].append(latency)
+        if status == 0 or status >= 500:
+            errors[route] += 1
+
+    routes = {}
+    for route, latencies in sorted(by_route.items()):
+        latencies.sort()
+        routes[route] = {
+            "count": len(latencies),
+            "errors": errors[route],
+            "rps": len(latencies) / elapsed,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        }
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "elapsed": elapsed,
+        "rps": len(results) / elapsed,
+        "routes": routes,
+    }
+
+
+def print_summary(summary: dict, baseline: dict = None):
+    print(f"{summary['requests']} requests in {summary['elapsed']:.2f}s, {summary['rps']:.1f} req/s")
+    print(f"{'route':45} {'count':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for route, stats in summary["routes"].items():
+        line = f"{route:45} {stats['count']:>6} {stats['errors']:>6}"
+        old = (baseline or {}).get("routes", {}).get(route)
+        for p in ("p50", "p95", "p99"):
+            cell = f"{stats[p] * 1000:.1f}"
+            if old:
+                cell += f" ({(stats[p] - old[p]) / old[p] * 100:+.0f}%)" if old[p] else ""
+            line += f" {cell:>9}"
+        print(line)
+
+
+async def main(args):
+    entries = load_log(args.log)
+    if not entries:
+        raise SystemExit(f"No requests found in {args.log}")
+    names = await resolve_route_names(entries)
+
+    server = None
+    url = args.url
+    if not url:
+        # In-process app on the configured Postgres, the same startup path as app.py
+        server = TestServer(await init_app())
+        await server.start_server()
+        url = str(server.make_url("")).rstrip("/")
+
+    try:
+        results, elapsed = await replay(url, entries, names, args.concurrency, args.repeat)
+    finally:
+        if server:
+            await server.close()
+
+    summary = summarize(results, elapsed, args.concurrency)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_summary(summary, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a JSONL request log and report latency per route name")
+    parser.add_argument("log", nargs="?", default="bench/requests.jsonl")
+    parser.add_argument("--url", help="target a running server instead of starting init_app in-process")
+    parser.add_argument("-c", "--concurrency", type=int, default=10)
+    parser.add_argument("-n", "--repeat", type=int, default=100, help="times the whole log is replayed")
+    parser.add_argument("--save", help="write the summary as a JSON baseline")
+    parser.add_argument("--compare", help="show deltas against a saved baseline")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,116 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class TemplateCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._by_id = OrderedDict()
+        self._id_by_type = {}
+        self._pages = OrderedDict()
+
+    def _lookup(self, store: OrderedDict, key) -> Optional[dict]:
+        entry = store.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del store[key]
+                if store is self._by_id:
+                    self._unindex(key, entry[1])
+            self.misses += 1
+            return None
+        store.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def _store(self, store: OrderedDict, key, value):
+        store[key] = (time.monotonic() + self.ttl, value)
+        store.move_to_end(key)
+        while len(store) > self.maxsize:
+            evicted_key, (_, evicted) = store.popitem(last=False)
+            if store is self._by_id:
+                self._unindex(evicted_key, evicted)
+
+    def _unindex(self, template_id: int, template: dict):
+        # The type may already point at a newer template, which keeps its entry
+        if self._id_by_type.get(template.get("type")) == template_id:
+            del self._id_by_type[template["type"]]
+
+    def get(self, template_id: int) -> Optional[dict]:
+        return self._lookup(self._by_id, template_id)
+
+    def get_by_type(self, template_type: str) -> Optional[dict]:
+        template_id = self._id_by_type.get(template_type)
+        entry = self._by_id.get(template_id) if template_id is not None else None
+        if entry is None or entry[1].get("type") != template_type:
+            # The template was evicted or retyped since it was indexed under this type
+            self._id_by_type.pop(template_type, None)
+            self.misses += 1
+            return None
+        return self.get(template_id)
+
+    def set(self, template: dict):
+        self._store(self._by_id, template["id"], template)
+        if template.get("type") is not None:
+            self._id_by_type[template["type"]] = template["id"]
+
+    def get_page(self, key: tuple) -> Optional[dict]:
+        return self._lookup(self._pages, key)
+
+    def set_page(self, key: tuple, page: dict):
+        self._store(self._pages, key, page)
+
+    def invalidate(self, template_id: Optional[int] = None):
+        # Any write can shift list pages, so those are always dropped
+        self._pages.clear()
+        if template_id is None:
+            return
+        entry = self._by_id.pop(template_id, None)
+        if entry is not None:
+            self._unindex(template_id, entry[1])
+
+    def clear(self):
+        self._by_id.clear()
+        self._id_by_type.clear()
+        self._pages.clear()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._by_id),
+            "pages": len(self._pages),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+        }
+
+
+class MergeCache:
+    # Merged user template configs keyed by the row and template versions they were built from,
+    # so an entry goes stale by never being asked for again and needs no invalidation
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._merged = OrderedDict()
+
+    def get(self, key: tuple):
+        config = self._merged.get(key)
+        if config is None:
+            self.misses += 1
+            return None
+        self._merged.move_to_end(key)
+        self.hits += 1
+        return config
+
+    def set(self, key: tuple, config):
+        self._merged[key] = config
+        self._merged.move_to_end(key)
+        while len(self._merged) > self.maxsize:
+            self._merged.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._merged), "maxsize": self.maxsize}
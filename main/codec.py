@@ -0,0 +1,44 @@
+import json
+from collections.abc import Mapping
+
+from aiohttp import web
+from aiopg.sa.result import RowProxy
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _default(obj):
+    # orjson has no hook for mappings, so a row still becomes one dict, but it is built straight from
+    # the raw tuple instead of a keymap lookup per column through the Mapping interface
+    if isinstance(obj, RowProxy) and not any(obj._processors):
+        return dict(zip(obj._result_proxy.keys, obj._row))
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson:
+    JSONDecodeError = orjson.JSONDecodeError
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj, default=_default)
+
+    loads = orjson.loads
+else:
+    JSONDecodeError = json.JSONDecodeError
+
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, default=_default).encode()
+
+    loads = json.loads
+
+
+def json_response(data, *, status: int = 200, headers=None) -> web.Response:
+    return web.Response(body=dumps(data), status=status, headers=headers, content_type="application/json")
+
+
+async def read_json(request: web.Request):
+    return await request.json(loads=loads)
@@ -0,0 +1,77 @@
+import os
+
+
+def _env(name: str, default, cast=str):
+    value = os.environ.get(name)
+    return default if value is None else cast(value)
+
+
+def _flag(value: str) -> bool:
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+def load_config() -> dict:
+    return {
+        "postgres": {
+            "database": _env("POSTGRES_DB", "postgres"),
+            "user": _env("POSTGRES_USER", "postgres"),
+            "password": _env("POSTGRES_PASSWORD", "password"),
+            "host": _env("POSTGRES_HOST", "postgres_db"),
+            "port": _env("POSTGRES_PORT", "5432"),
+            # Run the hot lookups in main/statements.py as server-side prepared statements
+            "prepared_statements": _env("POSTGRES_PREPARED_STATEMENTS", False, _flag),
+        },
+        "server": {
+            "host": _env("WEB_HOST", "0.0.0.0"),
+            "port": _env("WEB_PORT", 8080, int),
+            # worker processes sharing the port through SO_REUSEPORT
+            "workers": _env("WEB_WORKERS", 1, int),
+            # seconds a stopping worker waits for in-flight requests
+            "shutdown_timeout": _env("WEB_SHUTDOWN_TIMEOUT", 30.0, float),
+        },
+        # Pool sizes are the budget for the whole server, split evenly between workers
+        "pool": {
+            "minsize": _env("DB_POOL_MINSIZE", 1, int),
+            "maxsize": _env("DB_POOL_MAXSIZE", 10, int),
+            # seconds a request may wait for a free connection before getting a 503
+            "acquire_timeout": _env("DB_POOL_ACQUIRE_TIMEOUT", 5.0, float),
+            # seconds after which an idle connection is reopened, -1 to keep forever
+            "recycle": _env("DB_POOL_RECYCLE", -1.0, float),
+            # milliseconds, 0 disables the limit
+            "statement_timeout": _env("DB_STATEMENT_TIMEOUT", 0, int),
+        },
+        # Adaptive in-flight limits, separate budgets for GET/HEAD and for writes
+        "limiter": {
+            "read": {
+                "initial_limit": _env("READ_LIMIT_INITIAL", 50, int),
+                "max_limit": _env("READ_LIMIT_MAX", 500, int),
+                "latency_target": _env("READ_LATENCY_TARGET", 0.25, float),
+            },
+            "write": {
+                "initial_limit": _env("WRITE_LIMIT_INITIAL", 20, int),
+                "max_limit": _env("WRITE_LIMIT_MAX", 200, int),
+                "latency_target": _env("WRITE_LATENCY_TARGET", 0.5, float),
+            },
+        },
+        "sql_trace": {
+            # Add an X-SQL-Trace header with statement count and db time to every response
+            "debug": _env("SQL_TRACE_HEADER", False, _flag),
+            # seconds after which a request is logged with its statement summary
+            "slow_request": _env("SLOW_REQUEST_SECONDS", 1.0, float),
+            # identical statement shapes per request before an N+1 warning is logged
+            "repeat_threshold": _env("SQL_REPEAT_THRESHOLD", 3, int),
+        },
+        "profiling": {
+            # Requests sending this value in X-Profile run under cProfile, empty disables profiling
+            "token": _env("PROFILE_TOKEN", ""),
+            # Directory for .pstats dumps, when empty the text report replaces the response body
+            "dir": _env("PROFILE_DIR", ""),
+        },
+        "template_cache": {
+            "maxsize": _env("TEMPLATE_CACHE_MAXSIZE", 1024, int),
+            "ttl": _env("TEMPLATE_CACHE_TTL", 60.0, float),
+        },
+        "merge_cache": {
+            "maxsize": _env("MERGE_CACHE_MAXSIZE", 4096, int),
+        },
+    }
@@ -0,0 +1,199 @@
+from sqlalchemy import Text, and_, case, cast, func, literal, select, true, update
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+
+MERGE_PATCH = "application/merge-patch+json"
+JSON_PATCH = "application/json-patch+json"
+PATCH_CONTENT_TYPES = (MERGE_PATCH, JSON_PATCH)
+
+MAX_PATCH_OPS = 100
+
+
+class InvalidPatch(ValueError):
+    pass
+
+
+def _json(value):
+    return cast(literal(value, JSONB), JSONB)
+
+
+def _path(parts: list):
+    # the array bind is rendered with a ::TEXT[] cast already
+    return literal(parts, ARRAY(Text))
+
+
+def _get(doc, parts: list):
+    return doc.op("#>", return_type=JSONB)(_path(parts))
+
+
+def _concat(left, right):
+    return left.op("||", return_type=JSONB)(right)
+
+
+def compile_merge_patch(column, patch):
+    """RFC 7396 merge of `patch` into the jsonb `column`, as one SQL expression"""
+
+    def merge(target, patch):
+        if not isinstance(patch, dict):
+            return _json(patch)
+        result = case((func.jsonb_typeof(target) == "object", target), else_=_json({}))
+        removed = [key for key, value in patch.items() if value is None]
+        if removed:
+            result = result.op("-", return_type=JSONB)(_path(removed))
+        replaced = {key: value for key, value in patch.items() if value is not None and not isinstance(value, dict)}
+        if replaced:
+            result = _concat(result, _json(replaced))
+        # Nested objects are merged into what is stored under the key instead of replacing it
+        nested = []
+        for key, value in patch.items():
+            if isinstance(value, dict):
+                nested.extend([cast(literal(key), Text), merge(target.op("->", return_type=JSONB)(key), value)])
+        if nested:
+            result = _concat(result, func.jsonb_build_object(*nested, type_=JSONB))
+        return result
+
+    return merge(func.coalesce(column, _json({}), type_=JSONB), patch)
+
+
+def merge_patch(target, patch):
+    """RFC 7396 in Python, the same merge jsonb_merge_patch does in the database"""
+    if not isinstance(patch, dict):
+        return patch
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+
+def _pointer(pointer) -> list:
+    if not isinstance(pointer, str) or (pointer and not pointer.startswith("/")):
+        raise InvalidPatch(f"Invalid JSON pointer {pointer!r}")
+    if not pointer:
+        return []
+    return [part.replace("~1", "/").replace("~0", "~") for part in pointer[1:].split("/")]
+
+
+def _add(doc, parts: list, value, conditions: list):
+    if not parts:
+        return value
+    parent = _get(doc, parts[:-1])
+    is_array = func.jsonb_typeof(parent) == "array"
+    if parts[-1] == "-":
+        conditions.append(is_array)
+        appended = _concat(parent, func.jsonb_build_array(value, type_=JSONB))
+        return func.jsonb_set(doc, _path(parts[:-1]), appended, type_=JSONB) if len(parts) > 1 else appended
+    conditions.append(parent.isnot(None))
+    return case(
+        (is_array, func.jsonb_insert(doc, _path(parts), value, type_=JSONB)),
+        else_=func.jsonb_set(doc, _path(parts), value, True, type_=JSONB),
+    )
+
+
+def _remove(doc, parts: list, conditions: list):
+    if not parts:
+        raise InvalidPatch("Can't remove the whole document")
+    conditions.append(_get(doc, parts).isnot(None))
+    return doc.op("#-", return_type=JSONB)(_path(parts))
+
+
+def _compile_op(doc, op):
+    """Returns the patched document and the conditions the operation needs to apply"""
+    if not isinstance(op, dict) or not isinstance(op.get("op"), str):
+        raise InvalidPatch("Every operation must be an object with 'op' and 'path'")
+    name = op["op"]
+    parts = _pointer(op.get("path"))
+    if name in ("add", "replace", "test") and "value" not in op:
+        raise InvalidPatch(f"'{name}' needs a 'value'")
+    if name in ("move", "copy"):
+        source = _pointer(op.get("from"))
+
+    conditions = []
+    if name == "add":
+        doc = _add(doc, parts, _json(op["value"]), conditions)
+    elif name == "remove":
+        doc = _remove(doc, parts, conditions)
+    elif name == "replace":
+        conditions.append(_get(doc, parts).isnot(None))
+        doc = func.jsonb_set(doc, _path(parts), _json(op["value"]), False, type_=JSONB) if parts else _json(op["value"])
+    elif name == "test":
+        conditions.append(_get(doc, parts) == _json(op["value"]))
+    elif name == "move":
+        if parts[: len(source)] == source and len(parts) > len(source):
+            raise InvalidPatch("Can't move a value into one of its children")
+        value = _get(doc, source)
+        doc = _add(_remove(doc, source, conditions), parts, value, conditions)
+    elif name == "copy":
+        value = _get(doc, source)
+        conditions.append(value.isnot(None))
+        doc = _add(doc, parts, value, conditions)
+    else:
+        raise InvalidPatch(f"Unknown operation '{name}'")
+    return doc, and_(true(), *conditions)
+
+
+def apply_json_patch(base, operations):
+    """
+    RFC 6902 patch on top of `base`, a subquery with a jsonb `doc` column, an `ok` flag and key columns.
+    Every operation is a subquery over the previous one, so the SQL grows linearly with the patch.
+    The result has the same columns, `ok` is false when a test failed or a path was missing.
+    """
+    if not isinstance(operations, list) or not operations:
+        raise InvalidPatch("JSON Patch must be a non-empty array of operations")
+    if len(operations) > MAX_PATCH_OPS:
+        raise InvalidPatch(f"JSON Patch can have at most {MAX_PATCH_OPS} operations")
+
+    step = base
+    keys = [column for column in base.c if column.key not in ("doc", "ok")]
+    for i, op in enumerate(operations):
+        doc, condition = _compile_op(step.c.doc, op)
+        step = select(
+            *[step.c[column.key] for column in keys], doc.label("doc"), and_(step.c.ok, condition).label("ok")
+        ).subquery(f"patch_{i}")
+    return step
+
+
+def overlay_keeps(base_config, overlay, doc):
+    """
+    True when merging `overlay` back into `base_config` gives `doc`. A null in an overlay removes the key,
+    so a null in `doc` where the base has a value can't be stored and would silently read back as the base.
+    """
+    return func.jsonb_merge_patch(base_config, overlay, type_=JSONB) == doc
+
+
+def patch_config(table, criteria: list, content_type: str, patch, base_config=None):
+    """
+    UPDATE of `table.config` for the rows matching `criteria`, bumping their version.
+    With `base_config` the stored config is an overlay on it: the patch applies to the merged
+    document and the new overlay is stored, unless a JSON Patch sets a null the overlay can't keep.
+    `criteria` must then join the table of `base_config`.
+    """
+    doc = table.c.config
+    if base_config is not None:
+        doc = func.jsonb_merge_patch(base_config, doc, type_=JSONB)
+
+    if content_type == MERGE_PATCH:
+        config = compile_merge_patch(doc, patch)
+        if base_config is not None:
+            config = func.jsonb_merge_diff(base_config, config, type_=JSONB)
+        return update(table).where(*criteria).values(config=config, version=table.c.version + 1)
+
+    keys = list(table.primary_key.columns)
+    carried = [] if base_config is None else [base_config.label("base_config")]
+    base = (
+        select(*keys, *carried, func.coalesce(doc, _json({}), type_=JSONB).label("doc"), true().label("ok"))
+        .where(*criteria)
+        .subquery("patch_base")
+    )
+    patched = apply_json_patch(base, patch)
+    config = patched.c.doc
+    conditions = [patched.c.ok]
+    if base_config is not None:
+        config = func.jsonb_merge_diff(patched.c.base_config, config, type_=JSONB)
+        conditions.append(overlay_keeps(patched.c.base_config, config, patched.c.doc))
+    return (
+        update(table)
+        .where(*[key == patched.c[key.key] for key in keys], *conditions, *criteria)
+        .values(config=config, version=table.c.version + 1)
+    )
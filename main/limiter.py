@@ -0,0 +1,44 @@
+class AIMDLimiter:
+    # Additive increase / multiplicative decrease of the in-flight limit: every request that finishes
+    # under the latency target grows the limit by 1/limit, every slow or overloaded one shrinks it
+
+    def __init__(
+        self,
+        initial_limit: int = 20,
+        min_limit: int = 1,
+        max_limit: int = 200,
+        latency_target: float = 0.5,
+        backoff: float = 0.9,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.in_flight = 0
+        self.rejected = 0
+
+    def try_acquire(self) -> bool:
+        if self.in_flight >= int(self.limit):
+            self.rejected += 1
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self, latency: float, overloaded: bool = False):
+        self.in_flight -= 1
+        if overloaded or latency > self.latency_target:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+        elif self.in_flight + 1 >= int(self.limit):
+            # Only grow while the limit is actually being used, otherwise it drifts up during quiet periods
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def stats(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "rejected": self.rejected,
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "latency_target": self.latency_target,
+        }
@@ -0,0 +1,139 @@
+import os
+from contextvars import ContextVar
+from typing import Optional
+
+from main.histogram import Histogram
+
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+
+class RequestStats:
+    __slots__ = ("db_time", "pool_wait", "queries", "slowest_time", "slowest_query", "streamed")
+
+    def __init__(self):
+        self.db_time = 0.0
+        self.pool_wait = 0.0
+        # Statements are kept as issued and only turned into SQL text when a trace is reported
+        self.queries = []
+        self.slowest_time = 0.0
+        self.slowest_query = None
+        # Set by keyset-batched exports, whose statement repeats once per batch by design
+        self.streamed = False
+
+    def record(self, query, elapsed: float):
+        self.db_time += elapsed
+        self.queries.append(query)
+        if elapsed >= self.slowest_time:
+            self.slowest_time = elapsed
+            self.slowest_query = query
+
+
+# Stats of the request being handled by the current task, filled in by main.pool
+current_request_stats: ContextVar[Optional[RequestStats]] = ContextVar("current_request_stats", default=None)
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+
+
+def _with_label(line: str, label: str) -> str:
+    if line.startswith("#"):
+        return line
+    series, value = line.rsplit(" ", 1)
+    if series.endswith("}"):
+        return f"{series[:-1]},{label}}} {value}"
+    return f"{series}{{{label}}} {value}"
+
+
+class _Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *labels, value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{{{_labels(self.labels, labels)}}} {value}")
+        return lines
+
+
+class _Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple, buckets: Optional[tuple] = None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, *labels, value: float):
+        histogram = self.values.get(labels)
+        if histogram is None:
+            histogram = self.values[labels] = Histogram(self.buckets) if self.buckets else Histogram()
+        histogram.observe(value)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, histogram in self.values.items():
+            label_text = _labels(self.labels, labels)
+            for bound, total in histogram.cumulative():
+                le = "+Inf" if bound == float("inf") else bound
+                lines.append(f'{self.name}_bucket{{{label_text},le="{le}"}} {total}')
+            lines.append(f"{self.name}_sum{{{label_text}}} {histogram.sum}")
+            lines.append(f"{self.name}_count{{{label_text}}} {histogram.count}")
+        return lines
+
+
+class Metrics:
+    # Labels use route names from setup_routes, never raw paths, so cardinality stays bounded
+
+    def __init__(self):
+        self.requests = _Counter("http_requests_total", "Requests handled.", ("route", "method", "status"))
+        self.latency = _Histogram("http_request_duration_seconds", "Request latency.", ("route", "method"))
+        self.request_size = _Histogram(
+            "http_request_size_bytes", "Request body size.", ("route", "method"), SIZE_BUCKETS
+        )
+        self.response_size = _Histogram(
+            "http_response_size_bytes", "Response body size.", ("route", "method"), SIZE_BUCKETS
+        )
+        self.db_time = _Histogram("db_time_seconds", "Time spent executing SQL per request.", ("route", "method"))
+        self.pool_wait = _Histogram(
+            "db_pool_wait_seconds", "Time spent waiting for a pool connection per request.", ("route", "method")
+        )
+
+    def observe(
+        self,
+        route: str,
+        method: str,
+        status: int,
+        latency: float,
+        stats: RequestStats,
+        request_size: int,
+        response_size: int,
+    ):
+        self.requests.inc(route, method, status)
+        self.latency.observe(route, method, value=latency)
+        self.request_size.observe(route, method, value=request_size)
+        self.response_size.observe(route, method, value=response_size)
+        self.db_time.observe(route, method, value=stats.db_time)
+        self.pool_wait.observe(route, method, value=stats.pool_wait)
+
+    def render(self, extra: Optional[list] = None) -> str:
+        # Every worker process keeps its own metrics, the worker label keeps their series apart
+        worker = f'worker="{os.getpid()}"'
+        lines = []
+        for metric in (
+            self.requests,
+            self.latency,
+            self.request_size,
+            self.response_size,
+            self.db_time,
+            self.pool_wait,
+        ):
+            lines.extend(metric.render())
+        lines.extend(extra or [])
+        return "\n".join(_with_label(line, worker) for line in lines) + "\n"
@@ -1,36 +1,109 @@
+import time
+
 from aiohttp import web
-from json import JSONDecodeError
+from main.codec import JSONDecodeError, json_response, read_json
+from main.metrics import RequestStats, current_request_stats
+from main.jsonpatch import PATCH_CONTENT_TYPES
+from main.profiling import run_profiled, wants_profile
+from main.schemas import PATCH_ROUTES, VALIDATORS
+from main.tracing import report
 
 
 @web.middleware
-async def validate_id_middleware(request: web.Request, handler: web.Request):
-    try:
-        if "/template/" in request.raw_path:
-            item_id = request.match_info["template_id"]
-            if not item_id.isdigit():
-                return web.json_response({"status": "fail", "reason": "Template id should be an int!"}, status=400)
-        elif "/workspace/" in request.raw_path:
-            item_id = request.match_info["workspace_id"]
-            if not item_id.isdigit():
-                return web.json_response({"status": "fail", "reason": "Workspace id should be an int!"}, status=400)
-        elif "/user/" in request.raw_path:
-            item_id = request.match_info["user_id"]
-            if not item_id.isdigit():
-                return web.json_response({"status": "fail", "reason": "User id should be an int!"}, status=400)
-    except KeyError:
-        return web.json_response({"status": "Trailing slash. Remove it and try again"})
-    resp = await handler(request)
-    return resp
+async def profiling_middleware(request: web.Request, handler: web.Request):
+    if wants_profile(request):
+        return await run_profiled(request, handler)
+    return await handler(request)
 
 
 @web.middleware
 async def validate_json_body_middleware(request: web.Request, handler: web.Request):
     if request.method in ["POST", "PATCH"]:
         try:
-            data = await request.json()
-            if not data or isinstance(data, list):
-                return web.json_response({"status": "fail", "reason": "Invalid body!"}, status=400)
+            data = await read_json(request)
         except JSONDecodeError:
-            return web.json_response({"status": "fail", "reason": "Invalid json body!"}, status=400)
+            return json_response({"status": "fail", "reason": "Invalid json body!"}, status=400)
+
+        if request.content_type in PATCH_CONTENT_TYPES:
+            if request.method != "PATCH" or request.match_info.route.name not in PATCH_ROUTES:
+                return json_response(
+                    {"status": "fail", "reason": f"{request.content_type} is not supported here"}, status=415
+                )
+            request["json"] = data
+            return await handler(request)
+
+        if not data or not isinstance(data, dict):
+            return json_response({"status": "fail", "reason": "Invalid body!"}, status=400)
+
+        validator = VALIDATORS.get(request.match_info.route.name)
+        if validator:
+            error = validator(data)
+            if error:
+                return json_response({"status": "fail", "reason": error}, status=400)
+        # Handlers read the parsed body from here instead of decoding it again
+        request["json"] = data
     resp = await handler(request)
     return resp
+
+
+@web.middleware
+async def concurrency_limit_middleware(request: web.Request, handler: web.Request):
+    budget = "read" if request.method in ("GET", "HEAD") else "write"
+    limiter = request.app["limiters"][budget]
+    if not limiter.try_acquire():
+        return json_response(
+            {"status": "fail", "reason": "Server is overloaded, try again later"},
+            status=503,
+            headers={"Retry-After": "1"},
+        )
+
+    start = time.monotonic()
+    overloaded = False
+    streamed = False
+    try:
+        resp = await handler(request)
+        overloaded = resp.status == 503
+        # NDJSON exports are long by design, their duration says nothing about database health
+        streamed = not isinstance(resp, web.Response)
+        return resp
+    except web.HTTPException as e:
+        overloaded = e.status == 503
+        raise
+    finally:
+        limiter.release(0.0 if streamed else time.monotonic() - start, overloaded)
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler: web.Request):
+    stats = RequestStats()
+    token = current_request_stats.set(stats)
+    start = time.monotonic()
+    resp = None
+    status = 500
+    response_size = 0
+    try:
+        resp = await handler(request)
+        status = resp.status
+        # Streams are written by now (and report prepared as False again), their size is what was sent
+        if not isinstance(resp, web.Response) or resp.prepared:
+            response_size = resp.body_length
+        else:
+            response_size = resp.content_length or 0
+        return resp
+    except web.HTTPException as e:
+        resp = e
+        status = e.status
+        raise
+    finally:
+        current_request_stats.reset(token)
+        elapsed = time.monotonic() - start
+        request.app["metrics"].observe(
+            request.match_info.route.name or "unmatched",
+            request.method,
+            status,
+            elapsed,
+            stats,
+            request.content_length or 0,
+            response_size,
+        )
+        report(request, resp, stats, elapsed)
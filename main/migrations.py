@@ -0,0 +1,167 @@
+from psycopg2.errors import UndefinedTable
+
+# Serializes migrations between workers starting at the same time
+LOCK_ID = 7305221
+
+# (version, statements). Append only: a released migration never changes, the next one alters its result.
+MIGRATIONS = [
+    (
+        1,
+        [
+            """CREATE TABLE IF NOT EXISTS template (
+                id SERIAL NOT NULL,
+                config JSONB,
+                type VARCHAR(250),
+                version INTEGER DEFAULT '1' NOT NULL,
+                PRIMARY KEY (id),
+                UNIQUE (type)
+            )""",
+            """CREATE TABLE IF NOT EXISTS users (
+                id SERIAL NOT NULL,
+                name VARCHAR(100) NOT NULL,
+                PRIMARY KEY (id),
+                UNIQUE (name)
+            )""",
+            """CREATE TABLE IF NOT EXISTS workspace (
+                id SERIAL NOT NULL,
+                name VARCHAR(100) NOT NULL,
+                type VARCHAR(100),
+                version INTEGER DEFAULT '1' NOT NULL,
+                PRIMARY KEY (id),
+                UNIQUE (name)
+            )""",
+            """CREATE TABLE IF NOT EXISTS user_workspace (
+                id SERIAL NOT NULL,
+                workspace_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                PRIMARY KEY (id, workspace_id, user_id),
+                FOREIGN KEY(workspace_id) REFERENCES workspace (id) ON DELETE CASCADE,
+                FOREIGN KEY(user_id) REFERENCES users (id)
+            )""",
+            """CREATE INDEX IF NOT EXISTS ix_user_workspace_user_id_workspace_id
+                ON user_workspace (user_id, workspace_id)""",
+            """CREATE TABLE IF NOT EXISTS user_workspace_template (
+                id SERIAL NOT NULL,
+                user_id INTEGER NOT NULL,
+                workspace_id INTEGER NOT NULL,
+                template_id INTEGER NOT NULL,
+                config JSONB,
+                version INTEGER DEFAULT '1' NOT NULL,
+                PRIMARY KEY (id, user_id, workspace_id, template_id),
+                FOREIGN KEY(user_id) REFERENCES users (id),
+                FOREIGN KEY(workspace_id) REFERENCES workspace (id) ON DELETE CASCADE,
+                FOREIGN KEY(template_id) REFERENCES template (id)
+            )""",
+            """CREATE TABLE IF NOT EXISTS workspace_template (
+                workspace_id INTEGER NOT NULL,
+                template_id INTEGER NOT NULL,
+                PRIMARY KEY (workspace_id, template_id),
+                FOREIGN KEY(workspace_id) REFERENCES workspace (id),
+                FOREIGN KEY(template_id) REFERENCES template (id)
+            )""",
+        ],
+    ),
+    (
+        2,
+        [
+            # RFC 7396 merge; user template configs are stored as such patches over template.config
+            """CREATE OR REPLACE FUNCTION jsonb_merge_patch(target jsonb, patch jsonb) RETURNS jsonb
+            LANGUAGE plpgsql IMMUTABLE AS $$
+            BEGIN
+                IF patch IS NULL THEN
+                    RETURN target;
+                END IF;
+                IF jsonb_typeof(patch) <> 'object' THEN
+                    RETURN patch;
+                END IF;
+                IF target IS NULL OR jsonb_typeof(target) <> 'object' THEN
+                    target := '{}';
+                END IF;
+                RETURN (
+                    SELECT coalesce(jsonb_object_agg(merged.key, merged.value), '{}')
+                    FROM (
+                        SELECT t.key, t.value FROM jsonb_each(target) t WHERE NOT patch ? t.key
+                        UNION ALL
+                        SELECT p.key, jsonb_merge_patch(target -> p.key, p.value)
+                        FROM jsonb_each(patch) p
+                        WHERE jsonb_typeof(p.value) <> 'null'
+                    ) merged
+                );
+            END
+            $$""",
+            # The smallest patch turning base into doc, NULL when they are equal
+            """CREATE OR REPLACE FUNCTION jsonb_merge_diff(base jsonb, doc jsonb) RETURNS jsonb
+            LANGUAGE plpgsql IMMUTABLE AS $$
+            BEGIN
+                IF base IS NOT DISTINCT FROM doc THEN
+                    RETURN NULL;
+                END IF;
+                IF jsonb_typeof(base) IS DISTINCT FROM 'object' OR jsonb_typeof(doc) IS DISTINCT FROM 'object' THEN
+                    RETURN doc;
+                END IF;
+                RETURN (
+                    SELECT jsonb_object_agg(diff.key, diff.value)
+                    FROM (
+                        SELECT b.key, 'null'::jsonb AS value FROM jsonb_each(base) b WHERE NOT doc ? b.key
+                        UNION ALL
+                        SELECT d.key,
+                            CASE WHEN jsonb_typeof(d.value) = 'object' AND jsonb_typeof(base -> d.key) = 'object'
+                                THEN jsonb_merge_diff(base -> d.key, d.value)
+                                ELSE d.value
+                            END
+                        FROM jsonb_each(doc) d
+                        WHERE base -> d.key IS DISTINCT FROM d.value
+                    ) diff
+                );
+            END
+            $$""",
+            # Existing full copies become overlays, unchanged ones take no space at all
+            """UPDATE user_workspace_template u
+            SET config = jsonb_merge_diff(t.config, u.config)
+            FROM template t
+            WHERE t.id = u.template_id""",
+        ],
+    ),
+    (
+        3,
+        [
+            # Databases created by the old create_all on boot already had the tables, so 1 skipped them
+            # and never added these columns
+            "ALTER TABLE template ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+            "ALTER TABLE workspace ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+            "ALTER TABLE user_workspace_template ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+            """CREATE INDEX IF NOT EXISTS ix_user_workspace_user_id_workspace_id
+                ON user_workspace (user_id, workspace_id)""",
+        ],
+    ),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def schema_version(conn) -> int:
+    try:
+        return await conn.scalar("SELECT max(version) FROM schema_version") or 0
+    except UndefinedTable:
+        return 0
+
+
+async def migrate(conn) -> list:
+    # One query when the schema is current, which is every start except the first after a release
+    if await schema_version(conn) >= LATEST_VERSION:
+        return []
+
+    applied = []
+    async with conn.begin():
+        await conn.execute("SELECT pg_advisory_xact_lock(%(lock_id)s)", {"lock_id": LOCK_ID})
+        await conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY)")
+        # Another worker may have migrated while this one waited for the lock
+        current = await schema_version(conn)
+        for version, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            for statement in statements:
+                await conn.execute(statement)
+            await conn.execute("INSERT INTO schema_version (version) VALUES (%(version)s)", {"version": version})
+            applied.append(version)
+    return applied
@@ -1,5 +1,7 @@
 import aiopg.sa
-from sqlalchemy import Column, ForeignKey, Integer, MetaData, String
+from main.migrations import migrate
+from main.pool import InstrumentedEngine
+from sqlalchemy import Column, ForeignKey, Index, Integer, MetaData, String
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import backref, relationship
@@ -27,6 +29,7 @@ class Workspace_Template(Base):
 
 class User_Workspace(Base):
     __tablename__ = "user_workspace"
+    __table_args__ = (Index("ix_user_workspace_user_id_workspace_id", "user_id", "workspace_id"),)
     id = Column(Integer, autoincrement=True, primary_key=True)
     workspace_id = Column(Integer, ForeignKey("workspace.id", ondelete="CASCADE"), primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
@@ -45,7 +48,9 @@ class User_Workspace_Template(Base):
     user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
     workspace_id = Column(Integer, ForeignKey("workspace.id", ondelete="CASCADE"), primary_key=True)
     template_id = Column(Integer, ForeignKey("template.id"), primary_key=True)
+    # Overlay on template.config as a JSON merge patch, NULL while the user keeps the template as is
     config = Column(mutable_json_type(dbtype=JSONB, nested=True))
+    version = Column(Integer, nullable=False, server_default="1")
 
     def __init__(self, user_id=None, workspace_id=None, template_id=None):
         self.user_id = user_id
@@ -58,6 +63,7 @@ class Template(Base):
     id = Column(Integer, primary_key=True)
     config = Column(mutable_json_type(dbtype=JSONB, nested=True))
     type = Column(String(250), nullable=True, unique=True)
+    version = Column(Integer, nullable=False, server_default="1")
 
     workspaces = relationship("Workspace", secondary="workspace_template", viewonly=True)
 
@@ -74,6 +80,7 @@ class Workspace(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(100), nullable=False, unique=True)
     type = Column(String(100), nullable=True)
+    version = Column(Integer, nullable=False, server_default="1")
 
     templates = relationship("Template", secondary="workspace_template", viewonly=True)
 
@@ -101,14 +108,25 @@ class User(Base):
 
 async def pg_context(app):
     conf = app["config"]["postgres"]
+    pool_conf = app["config"]["pool"]
+    workers = app["config"]["server"]["workers"]
+    # A rolling restart runs one replacement next to the old workers, so that overlap fits the budget too
+    shares = workers + 1 if workers > 1 else 1
+    maxsize = max(1, pool_conf["maxsize"] // shares)
     engine = await aiopg.sa.create_engine(
         database=conf["database"],
         user=conf["user"],
         password=conf["password"],
         host=conf["host"],
         port=conf["port"],
+        minsize=min(pool_conf["minsize"] // shares, maxsize),
+        maxsize=maxsize,
+        pool_recycle=pool_conf["recycle"],
+        options=f"-c statement_timeout={pool_conf['statement_timeout']}",
     )
-    app["db"] = engine
+    async with engine.acquire() as conn:
+        await migrate(conn)
+    app["db"] = InstrumentedEngine(engine, acquire_timeout=pool_conf["acquire_timeout"])
 
     yield
 
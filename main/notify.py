@@ -0,0 +1,78 @@
+import asyncio
+import logging
+
+import aiopg
+from main import codec
+from sqlalchemy import func, select
+
+CHANNEL = "cache_invalidation"
+RECONNECT_DELAY = 1.0
+
+# entity name -> app key of the cache that holds it
+CACHES = {
+    "template": "template_cache",
+}
+
+logger = logging.getLogger(__name__)
+
+
+def evict(app, entity: str, entity_id=None):
+    cache_key = CACHES.get(entity)
+    if cache_key and cache_key in app:
+        app[cache_key].invalidate(entity_id)
+
+
+def evict_all(app):
+    for cache_key in CACHES.values():
+        if cache_key in app:
+            app[cache_key].clear()
+
+
+async def publish_change(request, conn, entity: str, entity_id=None):
+    # Evict locally right away so this worker never serves its own stale write,
+    # then let every other worker know through Postgres
+    evict(request.app, entity, entity_id)
+    payload = codec.dumps({"entity": entity, "id": entity_id}).decode()
+    await conn.execute(select(func.pg_notify(CHANNEL, payload)))
+
+
+async def _listen(app):
+    conf = app["config"]["postgres"]
+    while True:
+        try:
+            async with aiopg.connect(
+                database=conf["database"],
+                user=conf["user"],
+                password=conf["password"],
+                host=conf["host"],
+                port=conf["port"],
+            ) as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(f"LISTEN {CHANNEL}")
+                # Notifications may have been missed while we were disconnected
+                evict_all(app)
+                while True:
+                    msg = await conn.notifies.get()
+                    try:
+                        change = codec.loads(msg.payload)
+                        evict(app, change["entity"], change.get("id"))
+                    except (ValueError, KeyError):
+                        logger.warning("Bad invalidation payload: %r", msg.payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Invalidation listener lost connection, reconnecting")
+            evict_all(app)
+            await asyncio.sleep(RECONNECT_DELAY)
+
+
+async def listen_context(app):
+    task = asyncio.create_task(_listen(app))
+
+    yield
+
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
@@ -0,0 +1,107 @@
+import asyncio
+import time
+
+from aiohttp import web
+from main.codec import dumps
+from main.histogram import Histogram
+from main.metrics import current_request_stats
+
+
+class TracedConnection:
+    # Proxy for SAConnection that records every statement into the stats of the current request
+
+    def __init__(self, conn, stats):
+        self._conn = conn
+        self._stats = stats
+
+    async def execute(self, query, *multiparams, **params):
+        start = time.monotonic()
+        try:
+            return await self._conn.execute(query, *multiparams, **params)
+        finally:
+            self._stats.record(query, time.monotonic() - start)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class _AcquireContext:
+    def __init__(self, engine: "InstrumentedEngine"):
+        self._engine = engine
+        self._conn = None
+
+    async def __aenter__(self):
+        engine = self._engine
+        start = time.monotonic()
+        engine.waiters += 1
+        try:
+            self._conn = await asyncio.wait_for(engine.engine.acquire(), engine.acquire_timeout)
+        except asyncio.TimeoutError:
+            engine.timeouts += 1
+            # Fail fast instead of letting requests queue on the pool until clients give up
+            raise web.HTTPServiceUnavailable(
+                body=dumps({"status": "fail", "reason": "Database is busy, try again later"}),
+                content_type="application/json",
+                headers={"Retry-After": "1"},
+            )
+        finally:
+            engine.waiters -= 1
+            waited = time.monotonic() - start
+            engine.acquire_wait.observe(waited)
+
+        stats = current_request_stats.get()
+        if stats is None:
+            return self._conn
+        stats.pool_wait += waited
+        return TracedConnection(self._conn, stats)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._conn.close()
+
+
+class InstrumentedEngine:
+    # Wraps aiopg.sa.Engine so every acquire is bounded by a timeout and shows up in pool stats
+
+    def __init__(self, engine, acquire_timeout: float):
+        self.engine = engine
+        self.acquire_timeout = acquire_timeout
+        self.acquire_wait = Histogram()
+        self.waiters = 0
+        self.timeouts = 0
+
+    def acquire(self) -> _AcquireContext:
+        return _AcquireContext(self)
+
+    def close(self):
+        self.engine.close()
+
+    async def wait_closed(self):
+        await self.engine.wait_closed()
+
+    def stats(self) -> dict:
+        return {
+            "minsize": self.engine.minsize,
+            "maxsize": self.engine.maxsize,
+            "size": self.engine.size,
+            "free": self.engine.freesize,
+            "in_use": self.engine.size - self.engine.freesize,
+            "waiters": self.waiters,
+            "timeouts": self.timeouts,
+            "acquire_wait": self.acquire_wait.to_dict(),
+        }
+
+    def render_metrics(self) -> list:
+        return [
+            "# HELP db_pool_size Open connections in the pool.",
+            "# TYPE db_pool_size gauge",
+            f"db_pool_size {self.engine.size}",
+            "# HELP db_pool_free Idle connections in the pool.",
+            "# TYPE db_pool_free gauge",
+            f"db_pool_free {self.engine.freesize}",
+            "# HELP db_pool_waiters Requests waiting for a connection.",
+            "# TYPE db_pool_waiters gauge",
+            f"db_pool_waiters {self.waiters}",
+            "# HELP db_pool_acquire_timeouts_total Acquires that gave up waiting.",
+            "# TYPE db_pool_acquire_timeouts_total counter",
+            f"db_pool_acquire_timeouts_total {self.timeouts}",
+        ]
@@ -0,0 +1,66 @@
+import cProfile
+import hmac
+import io
+import logging
+import os
+import pstats
+import time
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "X-Profile"
+
+# cProfile hooks the whole thread, so only one request is profiled at a time
+_active = False
+
+
+def wants_profile(request: web.Request) -> bool:
+    token = request.app["config"]["profiling"]["token"]
+    supplied = request.headers.get(PROFILE_HEADER)
+    return bool(token) and supplied is not None and hmac.compare_digest(supplied, token) and not _active
+
+
+def _report(profiler: cProfile.Profile) -> str:
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(50)
+    return out.getvalue()
+
+
+async def run_profiled(request: web.Request, handler):
+    # Other tasks running on the loop meanwhile are sampled too, profile on a quiet worker for clean numbers
+    global _active
+    _active = True
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        resp = await handler(request)
+    except web.HTTPException as e:
+        resp = e
+    finally:
+        profiler.disable()
+        _active = False
+
+    # A finished stream reports prepared as False again, but it has been written and must be left alone
+    streamed = not isinstance(resp, web.Response) or resp.prepared
+
+    directory = request.app["config"]["profiling"]["dir"]
+    if directory:
+        name = f"{int(time.time() * 1000)}-{request.match_info.route.name or 'unmatched'}.pstats"
+        path = os.path.join(directory, name)
+        profiler.dump_stats(path)
+        if streamed:
+            logger.info("Profile of %s %s written to %s", request.method, request.path, path)
+        else:
+            resp.headers["X-Profile-File"] = path
+    elif streamed:
+        logger.info("Profile of %s %s:\n%s", request.method, request.path, _report(profiler))
+    else:
+        resp = web.Response(
+            text=_report(profiler), content_type="text/plain", headers={"X-Profiled-Status": str(resp.status)}
+        )
+
+    if isinstance(resp, web.HTTPException):
+        raise resp
+    return resp
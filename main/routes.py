@@ -1,5 +1,15 @@
+from functools import wraps
+
+from main.views.stats import (
+    get_limiter_stats,
+    get_merge_cache_stats,
+    get_metrics,
+    get_pool_stats,
+    get_template_cache_stats,
+)
 from main.views.template import (
     create_template,
+    create_templates_batch,
     delete_template_by_id,
     get_all_templates,
     get_template_by_id,
@@ -7,6 +17,7 @@ from main.views.template import (
 )
 from main.views.user import (
     create_user,
+    create_users_batch,
     create_user_template,
     create_user_workspace,
     delete_user_by_id,
@@ -14,6 +25,7 @@ from main.views.user import (
     delete_users_workspace,
     get_all_users,
     get_user_by_id,
+    get_user_tree,
     get_users_templates_for_workspace,
     get_users_workspaces,
     patch_users_template,
@@ -21,6 +33,7 @@ from main.views.user import (
 )
 from main.views.workspace import (
     create_workspace,
+    create_workspaces_batch,
     delete_workspace_by_id,
     get_all_workspaces,
     get_workspace_by_id,
@@ -29,50 +42,104 @@ from main.views.workspace import (
 )
 
 
+def with_int_ids(handler):
+    # Routes only match digit ids (see the {..:\d+} patterns below), so conversion can't fail
+    @wraps(handler)
+    async def wrapper(request):
+        match_info = request.match_info
+        for key in match_info:
+            match_info[key] = int(match_info[key])
+        return await handler(request)
+
+    return wrapper
+
+
 def setup_routes(app):
 
     app.router.add_get("/template", get_all_templates, name="get_all_templates")
-    app.router.add_get("/template/{template_id}", get_template_by_id, name="get_template_by_id")
+    app.router.add_get(r"/template/{template_id:\d+}", with_int_ids(get_template_by_id), name="get_template_by_id")
     app.router.add_post("/template", create_template, name="create_template")
-    app.router.add_patch("/template/{template_id}", update_template_by_id, name="update_template_by_id")
-    app.router.add_delete("/template/{template_id}", delete_template_by_id, name="delete_template_by_id")
+    app.router.add_post("/template/batch", create_templates_batch, name="create_templates_batch")
+    app.router.add_patch(
+        r"/template/{template_id:\d+}",
+        with_int_ids(update_template_by_id),
+        name="update_template_by_id",
+    )
+    app.router.add_delete(
+        r"/template/{template_id:\d+}",
+        with_int_ids(delete_template_by_id),
+        name="delete_template_by_id",
+    )
 
     app.router.add_get("/workspace", get_all_workspaces, name="get_all_workspaces")
-    app.router.add_get("/workspace/{workspace_id}", get_workspace_by_id, name="get_workspace_by_id")
+    app.router.add_get(r"/workspace/{workspace_id:\d+}", with_int_ids(get_workspace_by_id), name="get_workspace_by_id")
     app.router.add_post("/workspace", create_workspace, name="post_workspace")
-    app.router.add_patch("/workspace/{workspace_id}", update_workspace_by_id, name="update_workspace_by_id")
-    app.router.add_delete("/workspace/{workspace_id}", delete_workspace_by_id, name="delete_workspace_by_id")
+    app.router.add_post("/workspace/batch", create_workspaces_batch, name="create_workspaces_batch")
+    app.router.add_patch(
+        r"/workspace/{workspace_id:\d+}",
+        with_int_ids(update_workspace_by_id),
+        name="update_workspace_by_id",
+    )
+    app.router.add_delete(
+        r"/workspace/{workspace_id:\d+}",
+        with_int_ids(delete_workspace_by_id),
+        name="delete_workspace_by_id",
+    )
 
-    app.router.add_post("/workspace/{workspace_id}/link_template", link_template, name="link_workspace")
+    app.router.add_post(
+        r"/workspace/{workspace_id:\d+}/link_template",
+        with_int_ids(link_template),
+        name="link_workspace",
+    )
 
     app.router.add_get("/user", get_all_users, name="get_all_users")
-    app.router.add_get("/user/{user_id}", get_user_by_id, name="get_user_by_id")
-    app.router.add_patch("/user/{user_id}", update_user_by_id, name="update_user_by_id")
-    app.router.add_delete("/user/{user_id}", delete_user_by_id, name="delete_user_by_id")
+    app.router.add_get(r"/user/{user_id:\d+}", with_int_ids(get_user_by_id), name="get_user_by_id")
+    app.router.add_patch(r"/user/{user_id:\d+}", with_int_ids(update_user_by_id), name="update_user_by_id")
+    app.router.add_delete(r"/user/{user_id:\d+}", with_int_ids(delete_user_by_id), name="delete_user_by_id")
     app.router.add_post("/user", create_user, name="create_user")
+    app.router.add_post("/user/batch", create_users_batch, name="create_users_batch")
 
-    app.router.add_get("/user/{user_id}/workspace", get_users_workspaces, name="get_users_workspaces")
     app.router.add_get(
-        "/user/{user_id}/workspace/{workspace_id}/template",
-        get_users_templates_for_workspace,
+        r"/user/{user_id:\d+}/workspace",
+        with_int_ids(get_users_workspaces),
+        name="get_users_workspaces",
+    )
+    app.router.add_get(r"/user/{user_id:\d+}/tree", with_int_ids(get_user_tree), name="get_user_tree")
+    app.router.add_get(
+        r"/user/{user_id:\d+}/workspace/{workspace_id:\d+}/template",
+        with_int_ids(get_users_templates_for_workspace),
         name="get_users_templates_for_workspace",
     )
     app.router.add_patch(
-        "/user/{user_id}/workspace/{workspace_id}/template/{template_id}",
-        patch_users_template,
+        r"/user/{user_id:\d+}/workspace/{workspace_id:\d+}/template/{template_id:\d+}",
+        with_int_ids(patch_users_template),
         name="get_users_template_by_id_for_workspace",
     )
     app.router.add_delete(
-        "/user/{user_id}/workspace/{workspace_id}/template/{template_id}",
-        delete_users_template,
+        r"/user/{user_id:\d+}/workspace/{workspace_id:\d+}/template/{template_id:\d+}",
+        with_int_ids(delete_users_template),
         name="delete_users_template",
     )
 
     app.router.add_delete(
-        "/user/{user_id}/workspace/{workspace_id}",
-        delete_users_workspace,
+        r"/user/{user_id:\d+}/workspace/{workspace_id:\d+}",
+        with_int_ids(delete_users_workspace),
         name="delete_users_workspace",
     )
 
-    app.router.add_post("/user/{user_id}/workspace", create_user_workspace, name="user_new_workspace")
-    app.router.add_post("/user/{user_id}/workspace/{workspace_id}/template", create_user_template, name="user_new_template")
+    app.router.add_post(
+        r"/user/{user_id:\d+}/workspace",
+        with_int_ids(create_user_workspace),
+        name="user_new_workspace",
+    )
+    app.router.add_post(
+        r"/user/{user_id:\d+}/workspace/{workspace_id:\d+}/template",
+        with_int_ids(create_user_template),
+        name="user_new_template",
+    )
+
+    app.router.add_get("/metrics", get_metrics, name="get_metrics")
+    app.router.add_get("/stats/template_cache", get_template_cache_stats, name="get_template_cache_stats")
+    app.router.add_get("/stats/merge_cache", get_merge_cache_stats, name="get_merge_cache_stats")
+    app.router.add_get("/stats/pool", get_pool_stats, name="get_pool_stats")
+    app.router.add_get("/stats/limiter", get_limiter_stats, name="get_limiter_stats")
@@ -0,0 +1,57 @@
+CONFIG = {"required": True, "type": (list, dict)}
+NAME = {"required": True, "type": str}
+TEMPLATE_TYPES = {"type": list, "items": str}
+BATCH = {"required": True, "type": list, "items": dict}
+
+# route name -> body schema, see setup_routes
+SCHEMAS = {
+    "create_template": {"config": CONFIG, "type": {"required": True, "type": str}},
+    "update_template_by_id": {"config": CONFIG, "type": {"required": True, "type": str}},
+    "post_workspace": {"name": NAME, "type": {"required": True, "type": str}, "template_types": TEMPLATE_TYPES},
+    "update_workspace_by_id": {"name": NAME, "type": {"required": True, "type": str}},
+    "link_workspace": {"template_id": {"required": True, "type": int}},
+    "create_user": {"name": NAME},
+    "update_user_by_id": {"name": NAME},
+    "user_new_workspace": {"name": NAME, "type": {"required": True, "type": str}, "template_types": TEMPLATE_TYPES},
+    "get_users_template_by_id_for_workspace": {"config": CONFIG},
+    "user_new_template": {"config": CONFIG},
+    "create_users_batch": {"items": BATCH},
+    "create_workspaces_batch": {"items": BATCH},
+    "create_templates_batch": {"items": BATCH},
+}
+
+# Routes that also take a merge patch or JSON Patch of the config, checked when compiled in main/jsonpatch.py
+PATCH_ROUTES = {"update_template_by_id", "get_users_template_by_id_for_workspace"}
+
+# Batch items are checked one by one, so a bad item fails alone instead of the whole batch
+BATCH_ITEM_SCHEMAS = {
+    "create_users_batch": {"name": NAME},
+    "create_workspaces_batch": {"name": NAME, "type": {"required": True, "type": str}},
+    "create_templates_batch": {"config": CONFIG, "type": {"required": True, "type": str}},
+}
+
+
+def compile_schema(schema: dict):
+    checks = tuple(
+        (field, rule.get("required", False), rule.get("type"), rule.get("items")) for field, rule in schema.items()
+    )
+
+    def validate(data: dict):
+        for field, required, field_type, items_type in checks:
+            value = data.get(field)
+            if value is None or value == "" or value == [] or value == {}:
+                if required:
+                    return f"Field '{field}' is missing"
+                continue
+            # bool is an int subclass, but never a valid id
+            if field_type and (not isinstance(value, field_type) or isinstance(value, bool)):
+                return f"Field '{field}' has wrong type"
+            if items_type and not all(isinstance(x, items_type) for x in value):
+                return f"Field '{field}' has wrong item type"
+        return None
+
+    return validate
+
+
+VALIDATORS = {name: compile_schema(schema) for name, schema in SCHEMAS.items()}
+BATCH_ITEM_VALIDATORS = {name: compile_schema(schema) for name, schema in BATCH_ITEM_SCHEMAS.items()}
@@ -0,0 +1,167 @@
+import re
+import weakref
+
+from aiopg.sa.engine import get_dialect
+from main.models import Template, User, User_Workspace, User_Workspace_Template, Workspace
+from sqlalchemy import Text, bindparam, cast, func, literal_column, select
+from sqlalchemy.dialects.postgresql import JSONB, aggregate_order_by
+
+_dialect = get_dialect()
+_bind_re = re.compile(r"%\((\w+)\)s")
+
+# raw connection -> names of statements already PREPAREd on that session
+_prepared = weakref.WeakKeyDictionary()
+_use_prepared = False
+
+
+class Statement:
+    # SQL is compiled once at import time, so hot lookups skip SQLAlchemy's per-call compilation
+
+    def __init__(self, name: str, query):
+        self.name = name
+        self.query = query
+        self.columns = [column.key for column in query.selected_columns]
+        self.sql = str(query.compile(dialect=_dialect))
+        self._projections = {}
+
+        params = []
+        for param in _bind_re.findall(self.sql):
+            if param not in params:
+                params.append(param)
+        self.params = params
+        self.prepare_sql = f"PREPARE {name} AS " + _bind_re.sub(lambda m: f"${params.index(m.group(1)) + 1}", self.sql)
+        self.execute_sql = f"EXECUTE {name}" + (f"({', '.join(f'%({x})s' for x in params)})" if params else "")
+
+    def project(self, fields: list) -> "Statement":
+        """The same statement selecting only `fields`, compiled once per set of fields"""
+        if len(fields) == len(self.columns):
+            return self
+        key = tuple(fields)
+        statement = self._projections.get(key)
+        if statement is None:
+            statement = Statement(f"{self.name}_{len(self._projections) + 1}", project_columns(self.query, fields))
+            self._projections[key] = statement
+        return statement
+
+
+def project_columns(query, fields: list):
+    return query.with_only_columns(*[column for column in query.selected_columns if column.key in fields])
+
+
+def configure(prepared: bool = False):
+    global _use_prepared
+    _use_prepared = prepared
+
+
+async def execute(conn, statement: Statement, **params):
+    if not _use_prepared:
+        return await conn.execute(statement.sql, params)
+
+    prepared = _prepared.setdefault(conn.connection, set())
+    if statement.name not in prepared:
+        await conn.execute(statement.prepare_sql)
+        prepared.add(statement.name)
+    return await conn.execute(statement.execute_sql, params)
+
+
+def _page(query, id_column):
+    return query.where(id_column > bindparam("after")).order_by(id_column).limit(bindparam("limit"))
+
+
+SELECT_USER = Statement("select_user", select(User).where(User.id == bindparam("user_id")))
+SELECT_WORKSPACE = Statement("select_workspace", select(Workspace).where(Workspace.id == bindparam("workspace_id")))
+SELECT_TEMPLATE = Statement("select_template", select(Template).where(Template.id == bindparam("template_id")))
+SELECT_TEMPLATE_VERSION = Statement(
+    "select_template_version", select(Template.version).where(Template.id == bindparam("template_id"))
+)
+
+SELECT_USERS_PAGE = Statement("select_users_page", _page(select(User), User.id))
+SELECT_WORKSPACES_PAGE = Statement("select_workspaces_page", _page(select(Workspace), Workspace.id))
+SELECT_TEMPLATES_PAGE = Statement("select_templates_page", _page(select(Template), Template.id))
+SELECT_USERS_WORKSPACES_PAGE = Statement(
+    "select_users_workspaces_page",
+    _page(
+        select(Workspace).join(User_Workspace).where(User_Workspace.user_id == bindparam("user_id")),
+        Workspace.id,
+    ),
+)
+
+_users_templates = (
+    User_Workspace_Template.user_id == bindparam("user_id"),
+    User_Workspace_Template.workspace_id == bindparam("workspace_id"),
+)
+SELECT_USERS_TEMPLATES_PAGE = Statement(
+    "select_users_templates_page",
+    _page(select(User_Workspace_Template).where(*_users_templates), User_Workspace_Template.id),
+)
+SELECT_USERS_TEMPLATE_VERSIONS_PAGE = Statement(
+    "select_users_template_versions_page",
+    _page(
+        # Merged configs also change with the base template, so its version is part of the page tag
+        select(User_Workspace_Template.id, User_Workspace_Template.version, Template.version.label("template_version"))
+        .join(Template, Template.id == User_Workspace_Template.template_id)
+        .where(*_users_templates),
+        User_Workspace_Template.id,
+    ),
+)
+
+
+# Keys and constants are inlined, so the statement only takes user_id
+_EMPTY_ARRAY = literal_column("'[]'::jsonb")
+
+
+def _json_object(pairs: dict):
+    return func.jsonb_build_object(*[x for key, value in pairs.items() for x in (literal_column(f"'{key}'"), value)])
+
+
+def _tree_templates():
+    copy = User_Workspace_Template.__table__.alias("copy")
+    base = Template.__table__.alias("base")
+    item = _json_object(
+        {
+            "id": copy.c.id,
+            "template_id": copy.c.template_id,
+            "type": base.c.type,
+            "version": copy.c.version,
+            "config": func.jsonb_merge_patch(base.c.config, copy.c.config, type_=JSONB),
+        }
+    )
+    return (
+        select(func.jsonb_agg(aggregate_order_by(item, copy.c.id)))
+        .select_from(copy.join(base, base.c.id == copy.c.template_id))
+        .where(copy.c.user_id == User.id, copy.c.workspace_id == Workspace.id)
+        .correlate_except(copy, base)
+        .scalar_subquery()
+    )
+
+
+def _tree_workspaces():
+    item = _json_object(
+        {
+            "id": Workspace.id,
+            "name": Workspace.name,
+            "type": Workspace.type,
+            "version": Workspace.version,
+            "templates": func.coalesce(_tree_templates(), _EMPTY_ARRAY),
+        }
+    )
+    return (
+        select(func.jsonb_agg(aggregate_order_by(item, Workspace.id)))
+        .select_from(Workspace.__table__.join(User_Workspace.__table__))
+        .where(User_Workspace.user_id == User.id)
+        .scalar_subquery()
+    )
+
+
+# The whole tree is built and serialized by Postgres and fetched as JSON text
+SELECT_USER_TREE = Statement(
+    "select_user_tree",
+    select(
+        cast(
+            _json_object(
+                {"id": User.id, "name": User.name, "workspaces": func.coalesce(_tree_workspaces(), _EMPTY_ARRAY)}
+            ),
+            Text,
+        ).label("tree")
+    ).where(User.id == bindparam("user_id")),
+)
@@ -0,0 +1,48 @@
+import logging
+from collections import Counter
+
+from aiohttp import web
+from main.metrics import RequestStats
+
+logger = logging.getLogger(__name__)
+
+TRACE_HEADER = "X-SQL-Trace"
+
+
+def statement_shape(query) -> str:
+    # Bound values are placeholders in compiled SQL, so the same query with other ids has the same shape
+    return " ".join(str(query).split())
+
+
+def repeated_shapes(stats: RequestStats, threshold: int) -> dict:
+    if stats.streamed or len(stats.queries) < threshold:
+        return {}
+    counts = Counter(statement_shape(query) for query in stats.queries)
+    return {shape: count for shape, count in counts.items() if count >= threshold}
+
+
+def report(request: web.Request, resp, stats: RequestStats, elapsed: float):
+    conf = request.app["config"]["sql_trace"]
+    route = request.match_info.route.name or "unmatched"
+    count = len(stats.queries)
+
+    for shape, times in repeated_shapes(stats, conf["repeat_threshold"]).items():
+        logger.warning("Possible N+1 in %s %s: statement ran %d times: %s", request.method, route, times, shape)
+
+    if elapsed >= conf["slow_request"]:
+        logger.warning(
+            "Slow request %s %s took %.3fs: %d statements, %.3fs in db, %.3fs waiting for a connection, "
+            "slowest %.3fs: %s",
+            request.method,
+            request.path,
+            elapsed,
+            count,
+            stats.db_time,
+            stats.pool_wait,
+            stats.slowest_time,
+            statement_shape(stats.slowest_query) if stats.slowest_query is not None else "-",
+        )
+
+    if conf["debug"] and isinstance(resp, web.StreamResponse) and not resp.prepared:
+        db, slowest = stats.db_time * 1000, stats.slowest_time * 1000
+        resp.headers[TRACE_HEADER] = f"count={count};db={db:.1f}ms;slowest={slowest:.1f}ms"
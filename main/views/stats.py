@@ -0,0 +1,23 @@
+from aiohttp import web
+from main.codec import json_response
+
+
+async def get_metrics(request: web.Request) -> web.Response:
+    extra = request.app["db"].render_metrics() if "db" in request.app else []
+    return web.Response(text=request.app["metrics"].render(extra), content_type="text/plain", charset="utf-8")
+
+
+async def get_template_cache_stats(request: web.Request) -> web.json_response:
+    return json_response({"status": "ok", "data": request.app["template_cache"].stats()})
+
+
+async def get_merge_cache_stats(request: web.Request) -> web.json_response:
+    return json_response({"status": "ok", "data": request.app["merge_cache"].stats()})
+
+
+async def get_limiter_stats(request: web.Request) -> web.json_response:
+    return json_response({"status": "ok", "data": {budget: x.stats() for budget, x in request.app["limiters"].items()}})
+
+
+async def get_pool_stats(request: web.Request) -> web.json_response:
+    return json_response({"status": "ok", "data": request.app["db"].stats()})
@@ -1,87 +1,218 @@
 from aiohttp import web
+from main.codec import json_response
+from main.jsonpatch import PATCH_CONTENT_TYPES, InvalidPatch, patch_config
 from main.models import Template, User_Workspace_Template, Workspace_Template
-from psycopg2.errors import UniqueViolation
-from sqlalchemy import delete, insert, select, update
+from main.notify import publish_change
+from main.statements import SELECT_TEMPLATE, SELECT_TEMPLATE_VERSION, SELECT_TEMPLATES_PAGE, execute, project_columns
+from main.views.utils import (
+    MAX_BATCH_SIZE,
+    build_page,
+    etag_matches,
+    get_fields,
+    get_page_params,
+    insert_batch,
+    invalid_batch_response,
+    invalid_fields_response,
+    invalid_page_response,
+    make_etag,
+    narrowed_fields,
+    not_modified_response,
+    page_params,
+    stream_ndjson,
+    wants_ndjson,
+    with_etag,
+)
+from psycopg2.errors import DataError, UniqueViolation
+from sqlalchemy import any_, delete, insert, select, update
+from sqlalchemy.dialects.postgresql import array
 
 
 async def get_all_templates(request: web.Request) -> web.json_response:
+    fields = get_fields(request, SELECT_TEMPLATES_PAGE, required=("id", "version"))
+    if fields is None:
+        return invalid_fields_response(SELECT_TEMPLATES_PAGE)
+
+    if wants_ndjson(request):
+        return await stream_ndjson(request, project_columns(select(Template), fields), Template.id)
+
+    page = get_page_params(request)
+    if not page:
+        return invalid_page_response()
+    limit, after = page
+
+    cache = request.app["template_cache"]
+    page_key = (limit, after, *narrowed_fields(fields, SELECT_TEMPLATES_PAGE))
+    cached_page = cache.get_page(page_key)
+    if cached_page:
+        return json_response(cached_page)
+
     async with request.app["db"].acquire() as conn:
-        cursor = await conn.execute(select(Template))
+        cursor = await execute(conn, SELECT_TEMPLATES_PAGE.project(fields), **page_params(limit, after))
         data = await cursor.fetchall()
-        templates = [dict(q) for q in data]
-        return web.json_response({"status": "ok", "data": templates})
+        templates_page = build_page(data, limit)
+        cache.set_page(page_key, templates_page)
+        return json_response(templates_page)
+
+
+async def get_templates(conn, cache, template_ids) -> dict:
+    """Templates by id, from the cache where possible and one query for the rest"""
+    templates = {}
+    for template_id in template_ids:
+        template = cache.get(template_id)
+        if template:
+            templates[template_id] = template
+    missing = [x for x in template_ids if x not in templates]
+    if missing:
+        cursor = await conn.execute(select(Template).where(Template.id == any_(array(missing))))
+        for record in await cursor.fetchall():
+            template = dict(record)
+            cache.set(template)
+            templates[template["id"]] = template
+    return templates
 
 
 async def get_template_by_id(request: web.Request) -> web.json_response:
     template_id = request.match_info["template_id"]
+    fields = get_fields(request, SELECT_TEMPLATE, required=("id", "version"))
+    if fields is None:
+        return invalid_fields_response(SELECT_TEMPLATE)
+    narrowed = narrowed_fields(fields, SELECT_TEMPLATE)
+
+    cache = request.app["template_cache"]
+    template = cache.get(template_id)
+    if template:
+        etag = make_etag("template", template_id, template["version"], *narrowed)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        data = {x: template[x] for x in fields} if narrowed else template
+        return with_etag(json_response({"status": "ok", "data": data}), etag)
 
     async with request.app["db"].acquire() as conn:
-        cursor = await conn.execute(select(Template).where(Template.id == template_id))
+        if request.if_none_match:
+            # Check the version alone first so an unchanged config is never fetched
+            cursor = await execute(conn, SELECT_TEMPLATE_VERSION, template_id=template_id)
+            version = await cursor.scalar()
+            if version is not None:
+                etag = make_etag("template", template_id, version, *narrowed)
+                if etag_matches(request, etag):
+                    return not_modified_response(etag)
+
+        cursor = await execute(conn, SELECT_TEMPLATE.project(fields), template_id=template_id)
         if cursor.rowcount == 0:
-            return web.json_response(
+            return json_response(
                 {"status": "fail", "reason": f"Template {template_id} doesn't exist"},
                 status=404,
             )
         record = await cursor.fetchone()
-    return web.json_response({"status": "ok", "data": dict(record)})
+    template = dict(record)
+    # Only whole templates go to the cache
+    if not narrowed:
+        cache.set(template)
+    return with_etag(
+        json_response({"status": "ok", "data": template}),
+        make_etag("template", template_id, template["version"], *narrowed),
+    )
 
 
 async def create_template(request: web.Request) -> web.json_response:
-    data = await request.json()
+    data = request["json"]
 
-    config = data.get("config")
-    template_type = data.get("type")
-    if not config or not template_type:
-        return web.json_response({"status": "fail", "reason": "Some field is missing"}, status=400)
+    config = data["config"]
+    template_type = data["type"]
 
     async with request.app["db"].acquire() as conn:
         try:
             cursor = await conn.execute(insert(Template).values(config=config, type=template_type))
             new_template = await cursor.fetchone()
-            return web.json_response({"status": "ok", "data": dict(new_template)}, status=201)
+            await publish_change(request, conn, "template", new_template.id)
+            return json_response({"status": "ok", "data": new_template}, status=201)
         except UniqueViolation:
-            return web.json_response({"status": "fail", "reason": "Template with such type already exists"}, status=400)
+            return json_response({"status": "fail", "reason": "Template with such type already exists"}, status=400)
+
+
+async def create_templates_batch(request: web.Request) -> web.json_response:
+    if len(request["json"]["items"]) > MAX_BATCH_SIZE:
+        return invalid_batch_response()
+
+    async with request.app["db"].acquire() as conn:
+        results = await insert_batch(request, conn, Template, "type")
+        if any(x["status"] == "ok" for x in results):
+            await publish_change(request, conn, "template")
+    return json_response({"status": "ok", "data": results}, status=200)
+
+
+async def patch_template_config(request: web.Request, template_id: int) -> web.json_response:
+    try:
+        query = patch_config(Template.__table__, [Template.id == template_id], request.content_type, request["json"])
+    except InvalidPatch as e:
+        return json_response({"status": "fail", "reason": str(e)}, status=400)
+
+    async with request.app["db"].acquire() as conn:
+        try:
+            cursor = await conn.execute(query.returning(*Template.__table__.c))
+        except DataError as e:
+            return json_response(
+                {"status": "fail", "reason": f"Patch can't be applied: {e.diag.message_primary}"}, status=409
+            )
+        if cursor.rowcount == 0:
+            cursor = await execute(conn, SELECT_TEMPLATE_VERSION, template_id=template_id)
+            if await cursor.scalar() is None:
+                return json_response({"status": "fail", "reason": f"Template {template_id} doesn't exist"}, status=404)
+            return json_response({"status": "fail", "reason": "Patch test failed or a path doesn't exist"}, status=409)
+        updated_template = await cursor.fetchone()
+        await publish_change(request, conn, "template", template_id)
+        return json_response({"status": "ok", "data": updated_template}, status=200)
 
 
 async def update_template_by_id(request: web.Request) -> web.json_response:
     template_id = request.match_info["template_id"]
-    data = await request.json()
-
-    template_type = data.get("type")
-    config = data.get("config")
+    if request.content_type in PATCH_CONTENT_TYPES:
+        return await patch_template_config(request, template_id)
+    data = request["json"]
 
-    if not template_type or not config:
-        return web.json_response({"status": "fail", "reason": "Some field is missing"}, status=400)
+    template_type = data["type"]
+    config = data["config"]
 
     async with request.app["db"].acquire() as conn:
         try:
-            await conn.execute(
-                update(Template).where(Template.id == template_id).values(type=template_type, config=config)
+            cursor = await conn.execute(
+                update(Template)
+                .where(Template.id == template_id)
+                .values(type=template_type, config=config, version=Template.version + 1)
+                .returning(*Template.__table__.c)
             )
         except UniqueViolation:
-            return web.json_response(
+            return json_response(
                 {"status": "fail", "reason": f"Template with type '{template_type}' already exists"}, status=400
             )
-
-        cursor = await conn.execute(select(Template).where(Template.id == template_id))
         if cursor.rowcount == 0:
-            return web.json_response(
+            return json_response(
                 {"status": "fail", "reason": f"Template {template_id} doesn't exist"},
                 status=404,
             )
         updated_template = await cursor.fetchone()
-        return web.json_response({"status": "ok", "data": dict(updated_template)}, status=200)
+        await publish_change(request, conn, "template", template_id)
+        return json_response({"status": "ok", "data": updated_template}, status=200)
 
 
 async def delete_template_by_id(request: web.Request) -> web.json_response:
     template_id = request.match_info["template_id"]
 
+    # Links and user copies are removed by data-modifying CTEs in the same statement as the template
+    deleted_links = delete(Workspace_Template).where(Workspace_Template.template_id == template_id).cte("deleted_links")
+    deleted_copies = (
+        delete(User_Workspace_Template).where(User_Workspace_Template.template_id == template_id).cte("deleted_copies")
+    )
+
     async with request.app["db"].acquire() as conn:
-        cursor = await conn.execute(delete(Workspace_Template).where(Workspace_Template.template_id == template_id))
         cursor = await conn.execute(
-            delete(User_Workspace_Template).where(User_Workspace_Template.template_id == template_id)
+            delete(Template)
+            .where(Template.id == template_id)
+            .add_cte(deleted_links)
+            .add_cte(deleted_copies)
+            .returning(Template.id)
         )
-        cursor = await conn.execute(delete(Template).where(Template.id == template_id))
         if cursor.rowcount == 1:
-            return web.json_response({"status": "ok", "data": []}, status=200)
-        return web.json_response({"status": "fail", "reason": f"Template {template_id} doesn't exist"}, status=404)
+            await publish_change(request, conn, "template", template_id)
+            return json_response({"status": "ok", "data": []}, status=200)
+        return json_response({"status": "fail", "reason": f"Template {template_id} doesn't exist"}, status=404)
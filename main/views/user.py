@@ -1,54 +1,119 @@
 from aiohttp import web
+from main.codec import json_response
+from main.jsonpatch import PATCH_CONTENT_TYPES, InvalidPatch, merge_patch, overlay_keeps, patch_config
 from main.models import Template, User, User_Workspace, User_Workspace_Template, Workspace, Workspace_Template
+from main.notify import publish_change
+from main.statements import (
+    SELECT_USER,
+    SELECT_USER_TREE,
+    SELECT_USERS_PAGE,
+    SELECT_USERS_TEMPLATE_VERSIONS_PAGE,
+    SELECT_USERS_TEMPLATES_PAGE,
+    SELECT_USERS_WORKSPACES_PAGE,
+    execute,
+    project_columns,
+)
+from main.views.utils import (
+    MAX_BATCH_SIZE,
+    build_page,
+    etag_matches,
+    get_fields,
+    get_page_params,
+    insert_batch,
+    invalid_batch_response,
+    invalid_fields_response,
+    invalid_page_response,
+    make_page_etag,
+    narrowed_fields,
+    not_modified_response,
+    page_params,
+    stream_ndjson,
+    wants_ndjson,
+    with_etag,
+)
+from main.views.template import get_templates
 from main.views.workspace import link_templates
-from psycopg2.errors import ForeignKeyViolation, UniqueViolation
-from sqlalchemy import delete, insert, select, update
+from psycopg2.errors import DataError, ForeignKeyViolation, UniqueViolation
+from sqlalchemy import any_, cast, delete, func, insert, literal, or_, select, update
+from sqlalchemy.dialects.postgresql import JSONB, array
+
+# User template rows with the overlay merged into the base config, for statements that join template
+_merged_template_columns = [
+    *[column for column in User_Workspace_Template.__table__.c if column.key != "config"],
+    func.jsonb_merge_patch(Template.__table__.c.config, User_Workspace_Template.__table__.c.config, type_=JSONB).label(
+        "config"
+    ),
+]
 
 
 async def get_all_users(request: web.Request) -> web.json_response:
+    fields = get_fields(request, SELECT_USERS_PAGE)
+    if fields is None:
+        return invalid_fields_response(SELECT_USERS_PAGE)
+
+    if wants_ndjson(request):
+        return await stream_ndjson(request, project_columns(select(User), fields), User.id)
+
+    page = get_page_params(request)
+    if not page:
+        return invalid_page_response()
+    limit, after = page
+
     async with request.app["db"].acquire() as conn:
-        cursor = await conn.execute(select(User))
+        cursor = await execute(conn, SELECT_USERS_PAGE.project(fields), **page_params(limit, after))
         data = await cursor.fetchall()
-        users = [dict(q) for q in data]
-        return web.json_response({"status": "ok", "data": users})
+        return json_response(build_page(data, limit))
 
 
 async def get_user_by_id(request: web.Request) -> web.json_response:
     user_id = request.match_info["user_id"]
+    fields = get_fields(request, SELECT_USER)
+    if fields is None:
+        return invalid_fields_response(SELECT_USER)
 
     async with request.app["db"].acquire() as conn:
-        cursor = await conn.execute(select(User).where(User.id == user_id))
+        cursor = await execute(conn, SELECT_USER.project(fields), user_id=user_id)
         if cursor.rowcount == 0:
-            return web.json_response(
+            return json_response(
                 {"status": "fail", "reason": f"User {user_id} doesn't exist"},
                 status=404,
             )
         record = await cursor.fetchone()
-    return web.json_response({"status": "ok", "data": dict(record)})
+    return json_response({"status": "ok", "data": record})
 
 
-async def update_user_by_id(request: web.Request) -> web.json_response:
+async def get_user_tree(request: web.Request) -> web.Response:
     user_id = request.match_info["user_id"]
 
-    data = await request.json()
-    name = data.get("name")
+    async with request.app["db"].acquire() as conn:
+        cursor = await execute(conn, SELECT_USER_TREE, user_id=user_id)
+        tree = await cursor.scalar()
+    if tree is None:
+        return json_response({"status": "fail", "reason": f"User {user_id} doesn't exist"}, status=404)
+    # Postgres already serialized the tree, so it goes out without being decoded and encoded again
+    return web.Response(body=b'{"status":"ok","data":' + tree.encode() + b"}", content_type="application/json")
+
+
+async def update_user_by_id(request: web.Request) -> web.json_response:
+    user_id = request.match_info["user_id"]
 
-    if not name:
-        return web.json_response({"status": "fail", "reason": "Some field is missing"}, status=400)
+    name = request["json"]["name"]
 
     async with request.app["db"].acquire() as conn:
         try:
-            await conn.execute(update(User).where(User.id == user_id).values(name=name))
+            cursor = await conn.execute(
+                update(User).where(User.id == user_id).values(name=name).returning(*User.__table__.c)
+            )
         except UniqueViolation:
-            return web.json_response({"status": "fail", "reason": "User with such name already exists"}, status=400)
-        cursor = await conn.execute(select(User).where(User.id == user_id))
+            return json_response({"status": "fail", "reason": "User with such name already exists"}, status=400)
         if cursor.rowcount == 0:
-            return web.json_response(
+            return json_response(
                 {"status": "fail", "reason": f"User with id {user_id} doesn't exist"},
                 status=404,
             )
         updated_user = await cursor.fetchone()
-        return web.json_response({"status": "ok", "data": dict(updated_user)}, status=200)
+        await publish_change(request, conn, "user", updated_user.id)
+        return json_response({"status": "ok", "data": updated_user}, status=200)
 
 
 async def delete_user_by_id(request: web.Request) -> web.json_response:
@@ -57,105 +122,230 @@ async def delete_user_by_id(request: web.Request) -> web.json_response:
     async with request.app["db"].acquire() as conn:
         cursor = await conn.execute(delete(User).where(User.id == user_id))
         if cursor.rowcount == 1:
-            return web.json_response({"status": "ok", "data": []}, status=200)
-        return web.json_response({"status": "fail", "reason": f"User {user_id} doesn't exist"}, status=404)
+            await publish_change(request, conn, "user", user_id)
+            return json_response({"status": "ok", "data": []}, status=200)
+        return json_response({"status": "fail", "reason": f"User {user_id} doesn't exist"}, status=404)
 
 
 async def create_user(request: web.Request) -> web.json_response:
-    data = await request.json()
-    name = data.get("name")
-    if not name:
-        return web.json_response({"status": "fail", "reason": "Name can't be empty"}, status=400)
+    name = request["json"]["name"]
 
     async with request.app["db"].acquire() as conn:
         try:
             cursor = await conn.execute(insert(User).values(name=name))
             new_workspace = await cursor.fetchone()
-            return web.json_response({"status": "ok", "data": dict(new_workspace)}, status=201)
+            await publish_change(request, conn, "user", new_workspace.id)
+            return json_response({"status": "ok", "data": new_workspace}, status=201)
         except UniqueViolation:
-            return web.json_response({"status": "fail", "reason": "User with such name already exists"}, status=400)
+            return json_response({"status": "fail", "reason": "User with such name already exists"}, status=400)
+
+
+async def create_users_batch(request: web.Request) -> web.json_response:
+    if len(request["json"]["items"]) > MAX_BATCH_SIZE:
+        return invalid_batch_response()
+
+    async with request.app["db"].acquire() as conn:
+        results = await insert_batch(request, conn, User, "name")
+        if any(x["status"] == "ok" for x in results):
+            await publish_change(request, conn, "user")
+    return json_response({"status": "ok", "data": results}, status=200)
 
 
 async def get_users_workspaces(request: web.Request) -> web.json_response:
     user_id = request.match_info["user_id"]
+    fields = get_fields(request, SELECT_USERS_WORKSPACES_PAGE, required=("id", "version"))
+    if fields is None:
+        return invalid_fields_response(SELECT_USERS_WORKSPACES_PAGE)
+
+    if wants_ndjson(request):
+        return await stream_ndjson(
+            request,
+            project_columns(select(Workspace).join(User_Workspace).where(User_Workspace.user_id == user_id), fields),
+            Workspace.id,
+        )
+
+    page = get_page_params(request)
+    if not page:
+        return invalid_page_response()
+    limit, after = page
 
     async with request.app["db"].acquire() as conn:
-        cursor = await conn.execute(select(Workspace).join(User_Workspace).where(User_Workspace.user_id == user_id))
-        if cursor.rowcount == 0:
-            return web.json_response(
+        cursor = await execute(
+            conn, SELECT_USERS_WORKSPACES_PAGE.project(fields), user_id=user_id, **page_params(limit, after)
+        )
+        if cursor.rowcount == 0 and not after:
+            return json_response(
                 {"status": "fail", "reason": "User doesn't have any workspaces yet"},
                 status=404,
             )
         data = await cursor.fetchall()
-        user_workspaces = [dict(q) for q in data]
-    return web.json_response({"status": "okkkk", "data": user_workspaces})
+    return json_response(build_page(data, limit))
 
 
 async def create_user_workspace(request: web.Request) -> web.json_response:
     user_id = request.match_info["user_id"]
 
-    data = await request.json()
-    name = data.get("name")
-    workspace_type = data.get("type")
+    data = request["json"]
+    name = data["name"]
     template_types = data.get("template_types")
 
-    if not name or not user_id or not workspace_type:
-        return web.json_response({"status": "fail", "reason": "Some field is missing"}, status=400)
-
     async with request.app["db"].acquire() as conn:
         try:
-            cursor = await conn.execute(insert(Workspace).values(name=name))
-            new_user_workspace = await cursor.fetchone()
-
-            cursor = await conn.execute(
-                insert(User_Workspace).values(user_id=user_id, workspace_id=new_user_workspace.id)
-            )
+            # A failure at any step rolls back the workspace too, so no orphaned rows are left behind
+            async with conn.begin() as trans:
+                new_workspace = (
+                    insert(Workspace.__table__).values(name=name).returning(*Workspace.__table__.c).cte("new_workspace")
+                )
+                new_link = (
+                    insert(User_Workspace.__table__)
+                    .from_select(["user_id", "workspace_id"], select(literal(user_id), new_workspace.c.id))
+                    .cte("new_link")
+                )
+                cursor = await conn.execute(select(new_workspace).add_cte(new_link))
+                new_user_workspace = await cursor.fetchone()
 
-            if template_types:
-                response = await link_templates(conn, new_user_workspace.id, template_types)
-                if response["status"] == "fail":
-                    return web.json_response(response, status=400)
-
-            cursor = await conn.execute(select(Template).where(Template.type.in_(template_types)))
-            data = await cursor.fetchall()
-            for template in data:
-                cursor = await conn.execute(
-                    insert(User_Workspace_Template).values(
-                        user_id=user_id,
-                        workspace_id=new_user_workspace.id,
-                        template_id=template.id,
-                        config=template.config,
+                if template_types:
+                    response = await link_templates(
+                        conn, request.app["template_cache"], new_user_workspace.id, template_types
+                    )
+                    if response["status"] == "fail":
+                        await trans.rollback()
+                        return json_response(response, status=400)
+
+                    # No config is copied, the user's templates read the base until they change it
+                    await conn.execute(
+                        insert(User_Workspace_Template.__table__).from_select(
+                            ["user_id", "workspace_id", "template_id"],
+                            select(literal(user_id), literal(new_user_workspace.id), Template.id).where(
+                                Template.type == any_(array(template_types))
+                            ),
+                        )
                     )
-                )
 
-            return web.json_response({"status": "ok", "data": dict(new_user_workspace)}, status=201)
+            await publish_change(request, conn, "workspace", new_user_workspace.id)
+            return json_response({"status": "ok", "data": new_user_workspace}, status=201)
         except UniqueViolation:
-            return web.json_response(
-                {"status": "fail", "reason": "Workspace with such name already exists"}, status=400
-            )
+            return json_response({"status": "fail", "reason": "Workspace with such name already exists"}, status=400)
         except ForeignKeyViolation:
-            cursor = await conn.execute(delete(Workspace).where(Workspace.name == name))
-            return web.json_response({"status": "fail", "reason": "User with such id does not exist"}, status=400)
+            return json_response({"status": "fail", "reason": "User with such id does not exist"}, status=400)
+
+
+def merge_users_template(cache, row, base: dict) -> dict:
+    if row.config is None:
+        # Unchanged copy, the base config is shared as is
+        config = base["config"]
+    else:
+        key = (row.id, row.version, base["id"], base["version"])
+        config = cache.get(key)
+        if config is None:
+            config = merge_patch(base["config"], row.config)
+            cache.set(key, config)
+    return {**row, "config": config}
+
+
+def users_templates_etag(versions: list, narrowed: list) -> str:
+    # (id, version, template version) per row, the base version only counts when configs are in the response
+    if narrowed and "config" not in narrowed:
+        versions = [x[:2] for x in versions]
+    return make_page_etag("+".join(["user_templates", *narrowed]), versions)
 
 
 async def get_users_templates_for_workspace(request: web.Request) -> web.json_response:
     user_id = request.match_info["user_id"]
     workspace_id = request.match_info["workspace_id"]
+    fields = get_fields(request, SELECT_USERS_TEMPLATES_PAGE, required=("id", "version", "template_id"))
+    if fields is None:
+        return invalid_fields_response(SELECT_USERS_TEMPLATES_PAGE)
+    narrowed = narrowed_fields(fields, SELECT_USERS_TEMPLATES_PAGE)
+
+    if wants_ndjson(request):
+        return await stream_ndjson(
+            request,
+            project_columns(
+                select(*_merged_template_columns)
+                .join_from(User_Workspace_Template.__table__, Template.__table__)
+                .where(
+                    User_Workspace_Template.workspace_id == workspace_id, User_Workspace_Template.user_id == user_id
+                ),
+                fields,
+            ),
+            User_Workspace_Template.id,
+        )
+
+    page = get_page_params(request)
+    if not page:
+        return invalid_page_response()
+    limit, after = page
 
     async with request.app["db"].acquire() as conn:
-        cursor = await conn.execute(
-            select(User_Workspace_Template).where(
-                User_Workspace_Template.workspace_id == workspace_id, User_Workspace_Template.user_id == user_id
+        if request.if_none_match:
+            # Compare against ids and versions only, so an unchanged page never ships its configs
+            cursor = await execute(
+                conn,
+                SELECT_USERS_TEMPLATE_VERSIONS_PAGE,
+                user_id=user_id,
+                workspace_id=workspace_id,
+                **page_params(limit, after),
             )
+            versions = await cursor.fetchall()
+            if versions:
+                etag = users_templates_etag([(q.id, q.version, q.template_version) for q in versions], narrowed)
+                if etag_matches(request, etag):
+                    return not_modified_response(etag)
+
+        cursor = await execute(
+            conn,
+            SELECT_USERS_TEMPLATES_PAGE.project(fields),
+            user_id=user_id,
+            workspace_id=workspace_id,
+            **page_params(limit, after),
         )
-        if cursor.rowcount == 0:
-            return web.json_response(
+        if cursor.rowcount == 0 and not after:
+            return json_response(
                 {"status": "fail", "reason": "User doesn't have any templates yet"},
                 status=404,
             )
         data = await cursor.fetchall()
-        user_templates = [dict(q) for q in data]
-    return web.json_response({"status": "ok", "data": user_templates})
+        if "config" not in fields:
+            etag = users_templates_etag([(q.id, q.version) for q in data], narrowed)
+            return with_etag(json_response(build_page(data, limit)), etag)
+        bases = await get_templates(conn, request.app["template_cache"], {q.template_id for q in data})
+
+    merged = [merge_users_template(request.app["merge_cache"], q, bases[q.template_id]) for q in data]
+    etag = users_templates_etag([(q.id, q.version, bases[q.template_id]["version"]) for q in data], narrowed)
+    return with_etag(json_response(build_page(merged, limit)), etag)
+
+
+async def patch_users_template_config(request: web.Request, criteria: list) -> web.json_response:
+    table = User_Workspace_Template.__table__
+    try:
+        query = patch_config(
+            table, criteria, request.content_type, request["json"], base_config=Template.__table__.c.config
+        )
+    except InvalidPatch as e:
+        return json_response({"status": "fail", "reason": str(e)}, status=400)
+
+    async with request.app["db"].acquire() as conn:
+        try:
+            cursor = await conn.execute(query.returning(*_merged_template_columns))
+        except DataError as e:
+            return json_response(
+                {"status": "fail", "reason": f"Patch can't be applied: {e.diag.message_primary}"}, status=409
+            )
+        if cursor.rowcount == 0:
+            cursor = await conn.execute(select(table.c.version).where(*criteria))
+            if cursor.rowcount == 0:
+                return json_response({"status": "fail", "reason": "User's template doesn't exist"}, status=404)
+            return json_response(
+                {
+                    "status": "fail",
+                    "reason": "Patch test failed, a path doesn't exist or a template value was set to null",
+                },
+                status=409,
+            )
+        updated_template = await cursor.fetchone()
+        await publish_change(request, conn, "user", request.match_info["user_id"])
+        return json_response({"status": "ok", "data": updated_template}, status=200)
 
 
 async def patch_users_template(request: web.Request) -> web.json_response:
@@ -163,103 +353,159 @@ async def patch_users_template(request: web.Request) -> web.json_response:
     workspace_id = request.match_info["workspace_id"]
     template_id = request.match_info["template_id"]
 
-    data = await request.json()
-    config = data.get("config")
+    table = User_Workspace_Template.__table__
+    criteria = [
+        table.c.user_id == user_id,
+        table.c.template_id == template_id,
+        table.c.workspace_id == workspace_id,
+        Template.__table__.c.id == table.c.template_id,
+    ]
+    if request.content_type in PATCH_CONTENT_TYPES:
+        return await patch_users_template_config(request, criteria)
 
-    if not config:
-        return web.json_response({"status": "fail", "reason": "Config field is missing"}, status=400)
+    config = cast(literal(request["json"]["config"], JSONB), JSONB)
+    # Only the difference to the base template is stored
+    overlay = func.jsonb_merge_diff(Template.__table__.c.config, config, type_=JSONB)
 
     async with request.app["db"].acquire() as conn:
-        await conn.execute(
-            update(User_Workspace_Template)
-            .where(
-                User_Workspace_Template.user_id == user_id,
-                User_Workspace_Template.template_id == template_id,
-                User_Workspace_Template.workspace_id == workspace_id,
-            )
-            .values(config=config)
-        )
         cursor = await conn.execute(
-            select(User_Workspace_Template).where(
-                User_Workspace_Template.user_id == user_id,
-                User_Workspace_Template.template_id == template_id,
-                User_Workspace_Template.workspace_id == workspace_id,
-            )
+            update(table)
+            .where(*criteria, overlay_keeps(Template.__table__.c.config, overlay, config))
+            .values(config=overlay, version=table.c.version + 1)
+            .returning(*_merged_template_columns)
         )
         if cursor.rowcount == 1:
             updated_template = await cursor.fetchone()
-            return web.json_response({"status": "ok", "data": dict(updated_template)}, status=200)
-        return web.json_response({"status": "fail", "reason": ""}, status=400)
+            await publish_change(request, conn, "user", user_id)
+            return json_response({"status": "ok", "data": updated_template}, status=200)
+        cursor = await conn.execute(select(table.c.version).where(*criteria))
+        if cursor.rowcount == 1:
+            return json_response(
+                {"status": "fail", "reason": f"Config can't set to null a value of template {template_id}"}, status=400
+            )
+        return json_response({"status": "fail", "reason": ""}, status=400)
 
 
 async def delete_users_template(request: web.Request) -> web.json_response:
-    user_id = int(request.match_info["user_id"])
-    workspace_id = int(request.match_info["workspace_id"])
-    template_id = int(request.match_info["template_id"])
+    user_id = request.match_info["user_id"]
+    workspace_id = request.match_info["workspace_id"]
+    template_id = request.match_info["template_id"]
 
-    async with request.app["db"].acquire() as conn:
-        cursor = await conn.execute(
-            delete(User_Workspace_Template).where(
-                User_Workspace_Template.user_id == user_id,
-                User_Workspace_Template.workspace_id == workspace_id,
-                User_Workspace_Template.template_id == template_id,
-            )
+    # The user's copy, the workspace link and the user-only (untyped) template go in one statement
+    deleted_copy = (
+        delete(User_Workspace_Template.__table__)
+        .where(
+            User_Workspace_Template.user_id == user_id,
+            User_Workspace_Template.workspace_id == workspace_id,
+            User_Workspace_Template.template_id == template_id,
         )
+        .returning(User_Workspace_Template.template_id)
+        .cte("deleted_copy")
+    )
+    deleted_link = (
+        delete(Workspace_Template.__table__)
+        .where(
+            Workspace_Template.workspace_id == workspace_id,
+            Workspace_Template.template_id.in_(select(deleted_copy.c.template_id)),
+        )
+        .returning(Workspace_Template.template_id)
+        .cte("deleted_link")
+    )
+    # All CTEs see the rows as they were before the statement, so links and copies elsewhere are checked directly
+    linked_elsewhere = (
+        select(Workspace_Template.template_id)
+        .where(Workspace_Template.template_id == template_id, Workspace_Template.workspace_id != workspace_id)
+        .exists()
+    )
+    copied_elsewhere = (
+        select(User_Workspace_Template.template_id)
+        .where(
+            User_Workspace_Template.template_id == template_id,
+            or_(User_Workspace_Template.user_id != user_id, User_Workspace_Template.workspace_id != workspace_id),
+        )
+        .exists()
+    )
+    deleted_template = (
+        delete(Template.__table__)
+        .where(
+            Template.id.in_(select(deleted_link.c.template_id)),
+            Template.type == None,
+            ~linked_elsewhere,
+            ~copied_elsewhere,
+        )
+        .cte("deleted_template")
+    )
+
+    async with request.app["db"].acquire() as conn:
+        cursor = await conn.execute(select(deleted_copy.c.template_id).add_cte(deleted_link).add_cte(deleted_template))
         if cursor.rowcount == 1:
-            cursor = await conn.execute(delete(Workspace_Template).where(Workspace_Template.template_id == template_id))
-            if cursor.rowcount == 1:
-                cursor = await conn.execute(delete(Template).where(Template.id == template_id, Template.type == None))
-                return web.json_response({"status": "ok", "data": []}, status=200)
-        return web.json_response({"status": "fail", "reason": f"Template {template_id} doesn't exist"}, status=404)
+            await publish_change(request, conn, "template", template_id)
+            return json_response({"status": "ok", "data": []}, status=200)
+        return json_response({"status": "fail", "reason": f"Template {template_id} doesn't exist"}, status=404)
 
 
 async def delete_users_workspace(request: web.Request) -> web.json_response:
     user_id = request.match_info["user_id"]
     workspace_id = request.match_info["workspace_id"]
 
-    async with request.app["db"].acquire() as conn:
-        cursor = await conn.execute(select(User_Workspace))
-        all_workspaces = await cursor.fetchall()
-        all_workspaces = [dict(q) for q in all_workspaces]
-
-        user_workspaces = [x.get("workspace_id") for x in all_workspaces if x.get("user_id") == int(user_id)]
+    owned = select(User_Workspace.workspace_id).where(
+        User_Workspace.user_id == user_id, User_Workspace.workspace_id == workspace_id
+    )
+    # Template links have no cascade, they go in the same statement and only when the user owns the workspace
+    deleted_links = delete(Workspace_Template).where(Workspace_Template.workspace_id.in_(owned)).cte("deleted_links")
 
-        if int(workspace_id) not in user_workspaces:
-            return web.json_response(
-                {"status": "fail", "reason": f"Workspace {workspace_id} doesn't does not belong to user {user_id}"},
-                status=400,
+    async with request.app["db"].acquire() as conn:
+        # DELETE ... USING user_workspace checks ownership via the (user_id, workspace_id) index
+        cursor = await conn.execute(
+            delete(Workspace)
+            .where(
+                Workspace.id == workspace_id,
+                User_Workspace.workspace_id == Workspace.id,
+                User_Workspace.user_id == user_id,
             )
-
-        cursor = await conn.execute(delete(Workspace).where(Workspace.id == workspace_id))
+            .add_cte(deleted_links)
+            .returning(Workspace.id)
+        )
 
         if cursor.rowcount == 1:
-            return web.json_response({"status": "ok", "data": []}, status=200)
-        return web.json_response({"status": "fail", "reason": f"Workspace {workspace_id} doesn't exist"}, status=404)
+            await publish_change(request, conn, "workspace", workspace_id)
+            return json_response({"status": "ok", "data": []}, status=200)
+        return json_response(
+            {
+                "status": "fail",
+                "reason": f"Workspace {workspace_id} doesn't exist or does not belong to user {user_id}",
+            },
+            status=404,
+        )
 
 
 async def create_user_template(request: web.Request) -> web.json_response:
     user_id = request.match_info["user_id"]
     workspace_id = request.match_info["workspace_id"]
 
-    data = await request.json()
-    config = data["config"]
-    # template_type = data["type"]
+    config = request["json"]["config"]
 
-    # if not template_type and not config:
-    # return web.json_response({"status": "fail", "reason": "Some field is missing"}, status=400)
+    # CTEs are built on Core tables: with ORM entities SQLAlchemy 1.4 drops the add_cte() parts of a select
+    new_template = insert(Template.__table__).values(config=config).returning(*Template.__table__.c).cte("new_template")
+    new_copy = (
+        insert(User_Workspace_Template.__table__)
+        .from_select(
+            ["user_id", "workspace_id", "template_id"],
+            select(literal(user_id), literal(workspace_id), new_template.c.id),
+        )
+        .cte("new_copy")
+    )
+    new_link = (
+        insert(Workspace_Template.__table__)
+        .from_select(["workspace_id", "template_id"], select(literal(workspace_id), new_template.c.id))
+        .cte("new_link")
+    )
 
     async with request.app["db"].acquire() as conn:
         try:
-            cursor = await conn.execute(insert(Template).values(config=config))
+            cursor = await conn.execute(select(new_template).add_cte(new_copy).add_cte(new_link))
             new_user_template = await cursor.fetchone()
-            cursor = await conn.execute(
-                insert(User_Workspace_Template).values(
-                    user_id=user_id, workspace_id=workspace_id, template_id=new_user_template.id, config=config
-                )
-            )
-            cursor = await conn.execute(
-                insert(Workspace_Template).values(workspace_id=workspace_id, template_id=new_user_template.id)
-            )
-            return web.json_response({"status": "ok", "data": dict(new_user_template)}, status=201)
+            await publish_change(request, conn, "template", new_user_template.id)
+            return json_response({"status": "ok", "data": new_user_template}, status=201)
         except UniqueViolation:
-            return web.json_response({"status": "fail", "reason": "Template with such name already exists"}, status=400)
+            return json_response({"status": "fail", "reason": "Template with such name already exists"}, status=400)
@@ -1,11 +1,174 @@
-from json.decoder import JSONDecodeError
+import hashlib
+from typing import Optional
 
 from aiohttp import web
+from main.codec import JSONDecodeError, dumps, json_response, read_json
+from main.metrics import current_request_stats
+from main.schemas import BATCH_ITEM_SCHEMAS, BATCH_ITEM_VALIDATORS
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+MAX_BATCH_SIZE = 1000
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+STREAM_BATCH_SIZE = 500
 
 
 async def vaildate_body(request: web.Request):
     try:
-        data = await request.json()
+        data = await read_json(request)
         return data
     except JSONDecodeError:
         return
+
+
+def get_page_params(request: web.Request):
+    limit = request.query.get("limit", str(DEFAULT_PAGE_LIMIT))
+    after = request.query.get("after", "0")
+    if not limit.isdigit() or not after.isdigit():
+        return
+    limit = int(limit)
+    if not 0 < limit <= MAX_PAGE_LIMIT:
+        return
+    return limit, int(after)
+
+
+def page_params(limit: int, after: int) -> dict:
+    # Fetch one extra row so we know whether another page exists without a COUNT
+    return {"limit": limit + 1, "after": after}
+
+
+def build_page(rows: list, limit: int) -> dict:
+    next_after = rows[limit - 1]["id"] if len(rows) > limit else None
+    return {"status": "ok", "data": rows[:limit], "next": next_after}
+
+
+def invalid_page_response() -> web.Response:
+    return json_response(
+        {"status": "fail", "reason": f"limit should be an int in 1..{MAX_PAGE_LIMIT} and after should be an int"},
+        status=400,
+    )
+
+
+def get_fields(request: web.Request, statement, required: tuple = ("id",)) -> Optional[list]:
+    # ?fields=id,type narrows the SELECT itself, so unrequested columns like config never leave Postgres
+    raw = request.query.get("fields")
+    if raw is None:
+        return statement.columns
+    names = {x.strip() for x in raw.split(",")} - {""}
+    if not names or not names <= set(statement.columns):
+        return None
+    return [x for x in statement.columns if x in names or x in required]
+
+
+def narrowed_fields(fields: list, statement) -> list:
+    # Part of cache keys and ETags, empty for the full representation so those stay as they were
+    return [] if len(fields) == len(statement.columns) else fields
+
+
+def invalid_fields_response(statement) -> web.Response:
+    return json_response(
+        {"status": "fail", "reason": f"fields should be a comma separated list of {', '.join(statement.columns)}"},
+        status=400,
+    )
+
+
+def wants_ndjson(request: web.Request) -> bool:
+    return NDJSON_CONTENT_TYPE in request.headers.get("Accept", "")
+
+
+async def stream_ndjson(request: web.Request, query, id_column) -> web.StreamResponse:
+    # psycopg2 async connections can't use server-side cursors, so walk the table
+    # in keyset batches to keep memory flat and flush every batch as soon as it arrives
+    resp = web.StreamResponse(headers={"Content-Type": NDJSON_CONTENT_TYPE})
+    await resp.prepare(request)
+
+    stats = current_request_stats.get()
+    if stats is not None:
+        stats.streamed = True
+
+    after = 0
+    async with request.app["db"].acquire() as conn:
+        while True:
+            cursor = await conn.execute(query.where(id_column > after).order_by(id_column).limit(STREAM_BATCH_SIZE))
+            rows = await cursor.fetchmany(STREAM_BATCH_SIZE)
+            if not rows:
+                break
+            await resp.write(b"".join(dumps(q) + b"\n" for q in rows))
+            if len(rows) < STREAM_BATCH_SIZE:
+                break
+            after = rows[-1].id
+
+    await resp.write_eof()
+    return resp
+
+
+def make_etag(*parts) -> str:
+    return "-".join(str(x) for x in parts)
+
+
+def make_page_etag(name: str, rows: list) -> str:
+    # Hash ids together with versions, so updates, inserts and deletes on the page all change the tag
+    digest = hashlib.sha1(",".join(":".join(str(x) for x in q) for q in rows).encode()).hexdigest()
+    return make_etag(name, digest)
+
+
+def etag_matches(request: web.Request, etag: str) -> bool:
+    if_none_match = request.if_none_match
+    if not if_none_match:
+        return False
+    return any(x.value in (etag, "*") for x in if_none_match)
+
+
+def not_modified_response(etag: str) -> web.Response:
+    resp = web.Response(status=304)
+    resp.etag = etag
+    return resp
+
+
+def with_etag(resp: web.Response, etag: str) -> web.Response:
+    resp.etag = etag
+    return resp
+
+
+def invalid_batch_response() -> web.Response:
+    return json_response(
+        {"status": "fail", "reason": f"A batch can't have more than {MAX_BATCH_SIZE} items"},
+        status=400,
+    )
+
+
+async def insert_batch(request: web.Request, conn, model, key: str) -> list:
+    # One multi-row INSERT for the whole batch. ON CONFLICT DO NOTHING turns unique violations
+    # into missing RETURNING rows, which are then reported per item instead of aborting the batch
+    route_name = request.match_info.route.name
+    validate = BATCH_ITEM_VALIDATORS[route_name]
+    fields = tuple(BATCH_ITEM_SCHEMAS[route_name])
+    items = request["json"]["items"]
+
+    errors = {}
+    rows = []
+    for i, item in enumerate(items):
+        error = validate(item)
+        if error:
+            errors[i] = error
+        else:
+            rows.append({x: item[x] for x in fields})
+
+    created = {}
+    if rows:
+        table = model.__table__
+        cursor = await conn.execute(pg_insert(table).values(rows).on_conflict_do_nothing().returning(*table.c))
+        created = {q[key]: q for q in await cursor.fetchall()}
+
+    results = []
+    for i, item in enumerate(items):
+        if i in errors:
+            results.append({"status": "fail", "reason": errors[i]})
+            continue
+        row = created.pop(item[key], None)
+        if row is None:
+            results.append({"status": "fail", "reason": f"{model.__name__} with such {key} already exists"})
+        else:
+            results.append({"status": "ok", "data": row})
+    return results
@@ -1,126 +1,214 @@
 from aiohttp import web
+from main.codec import json_response
 import aiopg
+from main.cache import TemplateCache
 from main.models import Workspace, Workspace_Template, Template
-from main.views.utils import vaildate_body
+from main.notify import publish_change
+from main.statements import SELECT_WORKSPACE, SELECT_WORKSPACES_PAGE, execute, project_columns
+from main.views.utils import (
+    MAX_BATCH_SIZE,
+    build_page,
+    etag_matches,
+    get_fields,
+    get_page_params,
+    insert_batch,
+    invalid_batch_response,
+    invalid_fields_response,
+    invalid_page_response,
+    make_etag,
+    narrowed_fields,
+    not_modified_response,
+    page_params,
+    stream_ndjson,
+    vaildate_body,
+    wants_ndjson,
+    with_etag,
+)
 from psycopg2.errors import UniqueViolation, ForeignKeyViolation
-from sqlalchemy import delete, insert, select, update
+from sqlalchemy import any_, delete, insert, literal, select, update
+from sqlalchemy.dialects.postgresql import array
 
 
 async def get_all_workspaces(request: web.Request) -> web.json_response:
+    fields = get_fields(request, SELECT_WORKSPACES_PAGE, required=("id", "version"))
+    if fields is None:
+        return invalid_fields_response(SELECT_WORKSPACES_PAGE)
+
+    if wants_ndjson(request):
+        return await stream_ndjson(request, project_columns(select(Workspace), fields), Workspace.id)
+
+    page = get_page_params(request)
+    if not page:
+        return invalid_page_response()
+    limit, after = page
+
     async with request.app["db"].acquire() as conn:
-        cursor = await conn.execute(select(Workspace))
+        cursor = await execute(conn, SELECT_WORKSPACES_PAGE.project(fields), **page_params(limit, after))
         data = await cursor.fetchall()
-        workspaces = [dict(q) for q in data]
-    return web.json_response({"status": "ok", "data": workspaces})
+    return json_response(build_page(data, limit))
 
 
 async def get_workspace_by_id(request: web.Request) -> web.json_response:
     workspace_id = request.match_info["workspace_id"]
+    fields = get_fields(request, SELECT_WORKSPACE, required=("id", "version"))
+    if fields is None:
+        return invalid_fields_response(SELECT_WORKSPACE)
 
     async with request.app["db"].acquire() as conn:
-        cursor = await conn.execute(select(Workspace).where(Workspace.id == workspace_id))
+        cursor = await execute(conn, SELECT_WORKSPACE.project(fields), workspace_id=workspace_id)
         if cursor.rowcount == 0:
-            return web.json_response(
+            return json_response(
                 {"status": "fail", "reason": f"Workspace {workspace_id} doesn't exist"},
                 status=404,
             )
         record = await cursor.fetchone()
-    return web.json_response({"status": "ok", "data": dict(record)})
+    etag = make_etag("workspace", record.id, record.version, *narrowed_fields(fields, SELECT_WORKSPACE))
+    if etag_matches(request, etag):
+        return not_modified_response(etag)
+    return with_etag(json_response({"status": "ok", "data": record}), etag)
 
 
 async def create_workspace(request: web.Request) -> web.json_response:
-    data = await request.json()
+    data = request["json"]
 
-    name = data.get("name")
-    workspace_type = data.get("type")
+    name = data["name"]
+    workspace_type = data["type"]
     template_types = data.get("template_types")
-    if not name or not workspace_type:
-        return web.json_response({"status": "fail", "reason": "Some field is missing"}, status=400)
 
     async with request.app["db"].acquire() as conn:
         try:
-            cursor = await conn.execute(insert(Workspace).values(name=name, type=workspace_type))
-            new_workspace = await cursor.fetchone()
+            async with conn.begin() as trans:
+                cursor = await conn.execute(
+                    insert(Workspace).values(name=name, type=workspace_type).returning(*Workspace.__table__.c)
+                )
+                new_workspace = await cursor.fetchone()
+
+                if template_types:
+                    response = await link_templates(
+                        conn, request.app["template_cache"], new_workspace.id, template_types
+                    )
+                    if response["status"] == "fail":
+                        await trans.rollback()
+                        return json_response(response, status=400)
+
+            await publish_change(request, conn, "workspace", new_workspace.id)
+            return json_response({"status": "ok", "data": new_workspace}, status=201)
+        except UniqueViolation:
+            return json_response({"status": "fail", "reason": "Workspace with such name already exists"}, status=400)
 
-            if template_types:
-                response = await link_templates(conn, new_workspace.id, template_types)
-                if response["status"] == "fail":
-                    return web.json_response(response, status=400)
 
-            return web.json_response({"status": "ok", "data": dict(new_workspace)}, status=201)
-        except UniqueViolation:
-            return web.json_response({"status": "fail", "reason": "Workspace with such name already exists"}, status=400)
+async def create_workspaces_batch(request: web.Request) -> web.json_response:
+    if len(request["json"]["items"]) > MAX_BATCH_SIZE:
+        return invalid_batch_response()
+
+    async with request.app["db"].acquire() as conn:
+        results = await insert_batch(request, conn, Workspace, "name")
+        if any(x["status"] == "ok" for x in results):
+            await publish_change(request, conn, "workspace")
+    return json_response({"status": "ok", "data": results}, status=200)
 
 
 async def update_workspace_by_id(request: web.Request) -> web.json_response:
     # TODO: Remove workspace type field?
     workspace_id = request.match_info["workspace_id"]
-    data = await request.json()
+    data = request["json"]
 
-    name = data.get("name")
-    workspace_type = data.get("type")
-    if not name or not workspace_type:
-        return web.json_response({"status": "fail", "reason": "Some field is missing"}, status=400)
+    name = data["name"]
+    workspace_type = data["type"]
 
     async with request.app["db"].acquire() as conn:
-        await conn.execute(update(Workspace).where(Workspace.id == workspace_id).values(name=name, type=workspace_type))
-        cursor = await conn.execute(select(Workspace).where(Workspace.id == workspace_id))
+        cursor = await conn.execute(
+            update(Workspace)
+            .where(Workspace.id == workspace_id)
+            .values(name=name, type=workspace_type, version=Workspace.version + 1)
+            .returning(*Workspace.__table__.c)
+        )
         if cursor.rowcount == 0:
-            return web.json_response(
+            return json_response(
                 {"status": "fail", "reason": f"Workspace {workspace_id} doesn't exist"},
                 status=404,
             )
 
         updated_workspace = await cursor.fetchone()
-        return web.json_response({"status": "ok", "data": dict(updated_workspace)}, status=200)
+        await publish_change(request, conn, "workspace", updated_workspace.id)
+        return json_response({"status": "ok", "data": updated_workspace}, status=200)
 
 
 async def delete_workspace_by_id(request: web.Request) -> web.json_response:
     workspace_id = request.match_info["workspace_id"]
+    deleted_links = (
+        delete(Workspace_Template).where(Workspace_Template.workspace_id == workspace_id).cte("deleted_links")
+    )
     async with request.app["db"].acquire() as conn:
-        cursor = await conn.execute(delete(Workspace_Template).where(Workspace_Template.workspace_id == workspace_id))
-        cursor = await conn.execute(delete(Workspace).where(Workspace.id == workspace_id))
+        cursor = await conn.execute(
+            delete(Workspace).where(Workspace.id == workspace_id).add_cte(deleted_links).returning(Workspace.id)
+        )
         if cursor.rowcount == 1:
-            return web.json_response({"status": "ok", "data": []}, status=200)
-        return web.json_response({"status": "fail", "reason": f"Workspace {workspace_id} doesn't exist"}, status=404)
-
-
-async def link_templates(conn: aiopg.connection, workspace_id: int, template_types: list) -> dict:
+            await publish_change(request, conn, "workspace", workspace_id)
+            return json_response({"status": "ok", "data": []}, status=200)
+        return json_response({"status": "fail", "reason": f"Workspace {workspace_id} doesn't exist"}, status=404)
+
+
+async def link_templates(conn: aiopg.connection, cache: TemplateCache, workspace_id: int, template_types: list) -> dict:
+    template_types = list(set(template_types))
+
+    uncached_types = [x for x in template_types if not cache.get_by_type(x)]
+    missing_types = []
+    if uncached_types:
+        cursor = await conn.execute(select(Template).where(Template.type == any_(array(uncached_types))))
+        found_types = set()
+        for template in await cursor.fetchall():
+            cache.set(dict(template))
+            found_types.add(template.type)
+        missing_types = [x for x in uncached_types if x not in found_types]
+    if missing_types:
+        return {"status": "fail", "reason": f"Templates with types {missing_types} don't exist"}
+
+    # The cache can be behind other workers, so the types that were actually linked decide what is missing
+    linked = (
+        insert(Workspace_Template)
+        .from_select(
+            ["workspace_id", "template_id"],
+            select(literal(workspace_id), Template.id).where(Template.type == any_(array(template_types))),
+        )
+        .returning(Workspace_Template.template_id)
+        .cte("linked")
+    )
     try:
-        for template_type in template_types:
-            cursor = await conn.execute(select(Template).where(Template.type == template_type))
-            template = await cursor.fetchone()
-            cursor = await conn.execute(insert(Workspace_Template).values(template_id=template.id, workspace_id=workspace_id))
-        return {"status": "ok"}
-    except ForeignKeyViolation:
-        return {"status": "fail", "reason": f"Template {template.id} doesn't exist"}
+        cursor = await conn.execute(select(Template.type).join(linked, linked.c.template_id == Template.id))
     except UniqueViolation:
-        return {"status": "fail", "reason": f"Template {template.id} is already linked to workspace {workspace_id}"}
+        return {
+            "status": "fail",
+            "reason": f"Some of templates {template_types} are already linked to workspace {workspace_id}",
+        }
+    linked_types = {x.type for x in await cursor.fetchall()}
+    missing_types = [x for x in template_types if x not in linked_types]
+    if missing_types:
+        return {"status": "fail", "reason": f"Templates with types {missing_types} don't exist"}
+    return {"status": "ok"}
 
 
 async def link_template(request: web.Request) -> web.json_response:
     workspace_id = request.match_info["workspace_id"]
-    data = await request.json()
-
-    template_id = data.get("template_id")
-    if not template_id:
-        return web.json_response({"status": "fail", "reason": "Some field is missing"}, status=400)
+    template_id = request["json"]["template_id"]
 
     async with request.app["db"].acquire() as conn:
         try:
-            cursor = await conn.execute(insert(Workspace_Template).values(template_id=template_id, workspace_id=workspace_id))
             cursor = await conn.execute(
-                select(Workspace_Template).where(Workspace_Template.template_id == template_id, Workspace_Template.workspace_id == workspace_id)
+                insert(Workspace_Template)
+                .values(template_id=template_id, workspace_id=workspace_id)
+                .returning(*Workspace_Template.__table__.c)
             )
             new_workspace = await cursor.fetchone()
-            return web.json_response({"status": "ok", "data": dict(new_workspace)})
+            await publish_change(request, conn, "workspace", new_workspace.workspace_id)
+            return json_response({"status": "ok", "data": new_workspace})
         except ForeignKeyViolation:
-            return web.json_response(
+            return json_response(
                 {"status": "fail", "reason": f"Template {template_id} doesn't exist"},
                 status=404,
             )
         except UniqueViolation:
-            return web.json_response(
+            return json_response(
                 {"status": "fail", "reason": f"Template {template_id} is already linked to workspace {workspace_id}"},
                 status=404,
             )
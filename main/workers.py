@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+import socket
+import time
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# seconds a replacement worker gets to open its pool before a rolling restart gives up on it
+STARTUP_TIMEOUT = 30.0
+
+
+def _bind(host: str, port: int) -> socket.socket:
+    # Every worker binds its own socket, the kernel spreads incoming connections between them
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+async def _serve(app_factory, sock: socket.socket, shutdown_timeout: float, ready):
+    app = await app_factory()
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+
+    try:
+        await web.SockSite(runner, sock, shutdown_timeout=shutdown_timeout).start()
+        # Only once this worker accepts connections may a rolling restart stop the one it replaces
+        ready.set()
+        await stop.wait()
+    finally:
+        # Stops accepting and waits up to shutdown_timeout for in-flight requests
+        await runner.cleanup()
+
+
+def _run_worker(app_factory, host: str, port: int, shutdown_timeout: float, ready):
+    asyncio.run(_serve(app_factory, _bind(host, port), shutdown_timeout, ready))
+
+
+class Supervisor:
+    # Keeps N worker processes serving host:port; SIGHUP replaces them one by one, SIGTERM/SIGINT drains them
+
+    def __init__(self, app_factory, workers: int, host: str, port: int, shutdown_timeout: float):
+        self.app_factory = app_factory
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.shutdown_timeout = shutdown_timeout
+        self.processes = []
+        self._context = multiprocessing.get_context("spawn")
+        self._stopping = False
+        self._reload = False
+
+    def _spawn(self):
+        ready = self._context.Event()
+        process = self._context.Process(
+            target=_run_worker,
+            args=(self.app_factory, self.host, self.port, self.shutdown_timeout, ready),
+        )
+        # The event has to outlive the start of the child, which unpickles it from the parent
+        process.ready = ready
+        process.start()
+        return process
+
+    def _wait_ready(self, process) -> bool:
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline and not self._stopping:
+            if process.ready.wait(0.5):
+                return True
+            if not process.is_alive():
+                return False
+        return False
+
+    def _stop(self, processes: list):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self.shutdown_timeout + 5
+        for process in processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning("Worker %d did not drain in time, killing it", process.pid)
+                process.kill()
+                process.join()
+
+    def _rolling_restart(self):
+        for i, old in enumerate(list(self.processes)):
+            if self._stopping:
+                return
+            new = self._spawn()
+            if not self._wait_ready(new):
+                logger.error("Replacement worker %d failed to start, keeping the old ones", new.pid)
+                self._stop([new])
+                return
+            self.processes[i] = new
+            self._stop([old])
+        logger.info("Rolling restart finished")
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+
+        self.processes = [self._spawn() for _ in range(self.workers)]
+        print(f"======== Running on http://{self.host}:{self.port} with {self.workers} workers ========")
+
+        while not self._stopping:
+            if self._reload:
+                self._reload = False
+                self._rolling_restart()
+            for i, process in enumerate(self.processes):
+                if not process.is_alive() and not self._stopping:
+                    logger.warning("Worker %d exited with code %s, starting a new one", process.pid, process.exitcode)
+                    self.processes[i] = self._spawn()
+            time.sleep(0.5)
+
+        self._stop(self.processes)